@@ -0,0 +1,146 @@
+import os
+
+import torch
+import torch.nn.functional as F
+
+import hyperparams
+
+# Single place that decides which device, dtype and thread count every module
+# uses. Modules call get_device()/get_dtype() at run time rather than importing
+# values, so configure() can be called after they are imported
+
+_device = None
+_dtype = None
+_amp_dtype = None
+
+
+def available_cores():
+    # Cores this process is allowed to run on, which can be fewer than
+    # os.cpu_count() under taskset or a container CPU limit
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def configure(device=None, dtype=None, num_threads=None, amp_dtype=None):
+    global _device, _dtype
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    if dtype is None:
+        dtype = torch.float32
+    if isinstance(dtype, str):
+        dtype = getattr(torch, dtype)
+    _device = torch.device(device)
+    _dtype = dtype
+    set_amp_dtype(amp_dtype)
+    if _device.type == "cpu":
+        # The model is tiny, so intra-op parallelism over the batch is all there
+        # is; pin exactly one thread per available core, and keep inter-op
+        # threads at one since there is no graph-level parallelism to exploit
+        torch.set_num_threads(num_threads or available_cores())
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            # Can only be set before any inter-op work has started
+            pass
+    elif num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+
+def _ensure_configured():
+    if _device is None:
+        configure(
+            hyperparams.device,
+            hyperparams.dtype,
+            hyperparams.num_threads,
+            hyperparams.amp_dtype,
+        )
+
+
+def get_device():
+    _ensure_configured()
+    return _device
+
+
+def get_dtype():
+    _ensure_configured()
+    return _dtype
+
+
+def is_cpu():
+    return get_device().type == "cpu"
+
+
+# Mixed precision. Parameters (the master weights) stay in get_dtype(), and so
+# do gradients: the model's matmuls run their forward in the amp dtype through
+# linear below, while no_grad forwards (evaluation) simply run under autocast.
+# Logits and the float64 loss of util.cross_entropy_high_precision stay at full
+# precision
+
+
+def set_amp_dtype(amp_dtype):
+    # None disables mixed precision; otherwise eg "bfloat16" (supported on CPU
+    # and recent GPUs) or "float16" (GPU)
+    global _amp_dtype
+    if isinstance(amp_dtype, str):
+        amp_dtype = getattr(torch, amp_dtype)
+    _amp_dtype = amp_dtype
+
+
+def get_amp_dtype():
+    _ensure_configured()
+    return _amp_dtype
+
+
+def autocast():
+    # Context manager for model forwards; a no-op unless an amp dtype is set.
+    # Forwards that need gradients don't autocast, since autocast would also
+    # compute the gradients in the amp dtype
+    amp_dtype = get_amp_dtype()
+    enabled = amp_dtype is not None and not torch.is_grad_enabled()
+    return torch.autocast(
+        get_device().type, dtype=amp_dtype or torch.bfloat16, enabled=enabled
+    )
+
+
+class AmpLinear(torch.autograd.Function):
+    # F.linear with the forward computed in amp_dtype, but the output and the
+    # gradients in x's dtype. Gradients computed in bfloat16 (as under autocast)
+    # make add at p=47 grok hundreds of epochs early, whereas rounding only the
+    # forward changes the loss curves no more than a 1e-6 perturbation of the
+    # init does, see benchmark.validate_amp
+    generate_vmap_rule = True
+
+    @staticmethod
+    def forward(x, weight, bias, amp_dtype):
+        if bias is not None:
+            bias = bias.to(amp_dtype)
+        out = F.linear(x.to(amp_dtype), weight.to(amp_dtype), bias)
+        return out.to(x.dtype)
+
+    @staticmethod
+    def setup_context(ctx, inputs, output):
+        x, weight, bias, _ = inputs
+        ctx.save_for_backward(x, weight)
+        ctx.has_bias = bias is not None
+
+    @staticmethod
+    def backward(ctx, grad):
+        x, weight = ctx.saved_tensors
+        grad_x = grad_weight = grad_bias = None
+        if ctx.needs_input_grad[0]:
+            grad_x = grad @ weight
+        rows = grad.reshape(-1, grad.shape[-1])
+        if ctx.needs_input_grad[1]:
+            grad_weight = rows.T @ x.reshape(-1, x.shape[-1])
+        if ctx.has_bias and ctx.needs_input_grad[2]:
+            grad_bias = rows.sum(dim=0)
+        return grad_x, grad_weight, grad_bias, None
+
+
+def linear(x, weight, bias=None):
+    # F.linear, through AmpLinear when training with an amp dtype
+    amp_dtype = get_amp_dtype()
+    if amp_dtype is None or not torch.is_grad_enabled():
+        return F.linear(x, weight, bias)
+    return AmpLinear.apply(x, weight, bias, amp_dtype)
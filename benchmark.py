@@ -0,0 +1,551 @@
+import argparse
+import copy
+import fnmatch
+import functools
+import json
+import os
+import platform
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import torch
+
+import backend
+import data
+import factored
+from hyperparams import *
+from model import Attention, Transformer
+import plotting
+import sweep
+import train
+import util
+
+# Benchmarks for the training hot loop
+# Run with e.g. `python benchmark.py epochs --device cpu --threads 4`
+
+
+def timeit(fn, repeats=20, warmup=3):
+    # Mean seconds per call of fn
+    for _ in range(warmup):
+        fn()
+    if backend.get_device().type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if backend.get_device().type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+def bench_epochs(fn_name="add", num_epochs=200, warmup=10, compile=False):
+    # Epochs/sec of the full-batch training step run_training performs: a train
+    # and test forward, backward on the train loss and an AdamW step
+    model = train.make_model()
+    if compile:
+        model.compile()
+    optimizer, scheduler = train.make_optimizer(model)
+    train_data, test_data = data.task_datasets(fn_name)
+    for epoch in range(warmup + num_epochs):
+        if epoch == warmup:
+            start = time.perf_counter()
+        train_loss = util.full_loss(model, train_data)
+        test_loss = util.full_loss(model, test_data)
+        train_loss.backward()
+        optimizer.step()
+        scheduler.step()
+        optimizer.zero_grad()
+    if backend.get_device().type == "cuda":
+        torch.cuda.synchronize()
+    return num_epochs / (time.perf_counter() - start)
+
+
+def bench_attention(batch_sizes=(128, 1024, p * p, 4 * p * p)):
+    # Forward + backward time of Attention with the einsum path against the
+    # fused scaled_dot_product_attention path, after checking they agree
+    attn = Attention(d_model, num_heads, d_head, n_ctx)
+    attn.to(device=backend.get_device(), dtype=backend.get_dtype())
+    results = []
+    for batch in batch_sizes:
+        x = torch.randn(
+            batch, n_ctx, d_model, device=backend.get_device(), requires_grad=True
+        )
+        out_hooked = attn.hooked_forward(x)
+        (grad_hooked,) = torch.autograd.grad(out_hooked.sum(), x)
+        out_fused = attn.fused_forward(x)
+        (grad_fused,) = torch.autograd.grad(out_fused.sum(), x)
+        torch.testing.assert_close(out_fused, out_hooked, rtol=1e-4, atol=1e-5)
+        torch.testing.assert_close(grad_fused, grad_hooked, rtol=1e-4, atol=1e-4)
+        hooked = timeit(lambda: attn.hooked_forward(x).sum().backward())
+        fused = timeit(lambda: attn.fused_forward(x).sum().backward())
+        results.append((batch, hooked, fused))
+    return results
+
+
+def bench_fft(moduli=(p, 1009), width=64):
+    # 2D Fourier transform of a [p^2, width] activation (eg a slice of the MLP
+    # neurons) via the dense basis einsum against util.neel_fft2d, after checking
+    # they agree
+    results = []
+    for num in moduli:
+        basis = util.get_neel_fourier_basis(num)
+        mat = torch.randn(num * num, width, device=basis.device)
+
+        def dense():
+            grid = mat.reshape(num, num, width)
+            return torch.einsum("xyz,fx,Fy->fFz", grid, basis, basis)
+
+        fast = util.neel_fft2d(mat, num=num)
+        torch.testing.assert_close(
+            fast, dense().reshape(mat.shape), rtol=0, atol=1e-3
+        )
+        dense_time = timeit(dense, repeats=5, warmup=1)
+        fast_time = timeit(
+            lambda: util.neel_fft2d(mat, num=num), repeats=5, warmup=1
+        )
+        results.append((num, dense_time, fast_time))
+    return results
+
+
+# The loop-based DataFrame construction plotting.animate_* used to do, kept as
+# the reference for bench_plotting
+def loop_lines_frame(lines_list, snapshot_index, point_index, snapshot, xaxis, yaxis):
+    rows = []
+    for i in range(lines_list.shape[0]):
+        for j in range(lines_list.shape[1]):
+            rows.append([lines_list[i][j], snapshot_index[i], point_index[j]])
+    return pd.DataFrame(rows, columns=[yaxis, snapshot, xaxis])
+
+
+def loop_multi_lines_frame(lines_list, snapshot_index, point_index, y_index, snapshot):
+    rows = []
+    for i in range(lines_list.shape[0]):
+        for j in range(lines_list.shape[2]):
+            rows.append(
+                list(lines_list[i, :, j]) + [snapshot_index[i], point_index[j]]
+            )
+    return pd.DataFrame(rows, columns=y_index + [snapshot, "x"])
+
+
+def loop_scatter_frame(
+    lines_list, snapshot_index, color, snapshot, xaxis, yaxis, color_name
+):
+    rows = []
+    for i in range(lines_list.shape[0]):
+        for j in range(lines_list.shape[2]):
+            rows.append(
+                [
+                    lines_list[i, 0, j].item(),
+                    lines_list[i, 1, j].item(),
+                    snapshot_index[i],
+                    color[i, j],
+                ]
+            )
+    return pd.DataFrame(rows, columns=[xaxis, yaxis, snapshot, color_name])
+
+
+def bench_plotting(num_snapshots=500, num_points=512, num_lines=4):
+    # Time to build the animate_* DataFrames with the vectorized builders in
+    # plotting against the loops they replaced, after checking the frames are
+    # identical, also for lines decimated with a point_stride
+    rng = np.random.default_rng(seed)
+    snapshot_index = np.arange(num_snapshots) * 100
+    lines = rng.standard_normal((num_snapshots, num_points), dtype=np.float32)
+    multi = rng.standard_normal(
+        (num_snapshots, num_lines, num_points), dtype=np.float32
+    )
+    points = rng.standard_normal((num_snapshots, 2, num_points), dtype=np.float32)
+    color = rng.standard_normal((num_snapshots, num_points))
+    y_index = [str(i) for i in range(num_lines)]
+    point_index = np.arange(num_points)
+    cases = {
+        "animate_lines": (
+            plotting.lines_frame,
+            loop_lines_frame,
+            (lines, snapshot_index, point_index, "snapshot", "x", "y"),
+        ),
+        "animate_multi_lines": (
+            plotting.multi_lines_frame,
+            loop_multi_lines_frame,
+            (multi, snapshot_index, point_index, y_index, "snapshot"),
+        ),
+        "animate_scatter": (
+            plotting.scatter_frame,
+            loop_scatter_frame,
+            (points, snapshot_index, color, "snapshot", "x", "y", "color"),
+        ),
+    }
+    results = []
+    for name, (vectorized, loop, args) in cases.items():
+        pd.testing.assert_frame_equal(vectorized(*args), loop(*args))
+        if vectorized != plotting.scatter_frame:
+            # Decimated points keep their original x, ie the frame is the full
+            # one without the skipped points
+            values, index, kept, _ = plotting.decimate(args[0], args[1], None, 1, 2)
+            expected = loop(*args)
+            expected = expected[expected["x"] % 2 == 0].reset_index(drop=True)
+            pd.testing.assert_frame_equal(
+                vectorized(values, index, kept, *args[3:]), expected
+            )
+        loop_time = timeit(lambda: loop(*args), repeats=1, warmup=0)
+        vectorized_time = timeit(lambda: vectorized(*args), repeats=5, warmup=1)
+        results.append((name, loop_time, vectorized_time))
+    return results
+
+
+# Micro-benchmark suite for the hot paths, with results stored as JSON baselines
+# per machine. `python benchmark.py suite` times every case, compares against
+# the baseline recorded for this machine (recording it for cases that have none)
+# and exits nonzero if any case got slower than the baseline by more than
+# --threshold
+BASELINE_PATH = Path(__file__).parent / "benchmark_baselines.json"
+# (p, d_model, batch) for the Transformer forward and backward cases
+SUITE_MODEL_SIZES = [
+    (23, 128, 23 * 23),
+    (113, 128, 1024),
+    (113, 128, 113 * 113),
+    (113, 256, 113 * 113),
+]
+
+
+def best_time(fn, min_repeats=5, min_seconds=0.5, warmup=1):
+    # Fastest call of fn over at least min_repeats calls and min_seconds. Other
+    # load on the machine only ever adds time, so the minimum is the steadiest
+    # statistic to check for regressions
+    for _ in range(warmup):
+        fn()
+    times = []
+    while len(times) < min_repeats or sum(times) < min_seconds:
+        start = time.perf_counter()
+        fn()
+        if backend.get_device().type == "cuda":
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def machine_key():
+    # Identifies the hardware and software a baseline is valid for
+    cpu = platform.processor() or platform.machine()
+    if os.path.exists("/proc/cpuinfo"):
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    cpu = line.split(":", 1)[1].strip()
+                    break
+    device = backend.get_device()
+    if device.type == "cuda":
+        cpu = torch.cuda.get_device_name(device)
+    return (
+        f"{cpu} | {device.type} x{torch.get_num_threads()} threads | "
+        f"torch {torch.__version__}"
+    )
+
+
+def suite_model(num, model_d, device):
+    model = Transformer(
+        num_layers=num_layers,
+        d_vocab=num + 1,
+        d_model=model_d,
+        d_mlp=4 * model_d,
+        d_head=model_d // num_heads,
+        num_heads=num_heads,
+        n_ctx=n_ctx,
+        act_type=act_type,
+        use_cache=False,
+        use_ln=use_ln,
+    )
+    return model.to(device=device, dtype=backend.get_dtype())
+
+
+def suite_cases():
+    # name -> zero argument setup function, which returns the zero argument
+    # function to time. Setup only runs for the cases selected, and isn't timed.
+    # Setup shared between cases is cached in suite_setup
+    device = backend.get_device()
+    cases = {}
+    for num, model_d, batch in SUITE_MODEL_SIZES:
+        name = f"p={num},d_model={model_d},batch={batch}"
+
+        def forward(num=num, model_d=model_d, batch=batch):
+            model = suite_model(num, model_d, device)
+            inputs = data.grid_inputs(num, device)[:batch]
+
+            def run():
+                with torch.no_grad():
+                    model(inputs)
+
+            return run
+
+        def forward_backward(num=num, model_d=model_d, batch=batch):
+            model = suite_model(num, model_d, device)
+            inputs = data.grid_inputs(num, device)[:batch]
+            return lambda: model(inputs).sum().backward()
+
+        cases[f"transformer_forward[{name}]"] = forward
+        cases[f"transformer_forward_backward[{name}]"] = forward_backward
+
+    def attention_forward():
+        attn = Attention(d_model, num_heads, d_head, n_ctx)
+        attn.to(device=device, dtype=backend.get_dtype())
+        x = torch.randn(p * p, n_ctx, d_model, device=device)
+        return lambda: attn(x)
+
+    def full_loss_backward():
+        model, train_data = suite_setup("model"), suite_setup("train_data")
+        return lambda: util.full_loss(model, train_data).backward()
+
+    def grid_logits(evaluator_type):
+        def setup():
+            model, train_data = suite_setup("model"), suite_setup("train_data")
+            evaluator = evaluator_type(train_data, train_data[:0])
+            return lambda: evaluator.logits(model)
+
+        return setup
+
+    def cross_entropy():
+        train_data = suite_setup("train_data")
+        logits = torch.randn(
+            len(train_data), p + 1, device=device, requires_grad=True
+        )
+        return lambda: util.cross_entropy_high_precision(
+            logits, train_data.labels
+        ).backward()
+
+    def make_predicate_arrays():
+        train, test = data.gen_train_test(frac_train, p, seed)
+        return lambda: data.make_predicate_arrays(train, test, p)
+
+    def fft2d():
+        basis = util.get_neel_fourier_basis(p, device)
+        mat = suite_setup("mat")
+        return lambda: util.fft2d(basis, mat)
+
+    def neel_fft2d():
+        mat = suite_setup("mat")
+        return lambda: util.neel_fft2d(mat, num=p)
+
+    def frame(builder, shape, *args):
+        def setup():
+            rng = np.random.default_rng(seed)
+            values = rng.standard_normal(shape, dtype=np.float32)
+            return lambda: builder(values, np.arange(500), np.arange(512), *args)
+
+        return setup
+
+    def scatter_frame():
+        rng = np.random.default_rng(seed)
+        points = rng.standard_normal((500, 2, 512), dtype=np.float32)
+        color = rng.standard_normal((500, 512))
+        return lambda: plotting.scatter_frame(points, np.arange(500), color)
+
+    cases[f"attention_forward[batch={p * p}]"] = attention_forward
+    cases[f"full_loss_backward[p={p}]"] = full_loss_backward
+    cases[f"grid_logits[p={p}]"] = grid_logits(util.GridEvaluator)
+    cases[f"factored_grid_logits[p={p}]"] = grid_logits(
+        factored.FactoredGridEvaluator
+    )
+    num_train = int(frac_train * p * p)
+    cases[f"cross_entropy_high_precision[batch={num_train}]"] = cross_entropy
+    cases[f"gen_train_test[p={p}]"] = lambda: (
+        lambda: data.gen_train_test(frac_train, p, seed)
+    )
+    cases[f"make_predicate_arrays[p={p}]"] = make_predicate_arrays
+    cases[f"fft2d[p={p},width={d_mlp}]"] = fft2d
+    cases[f"neel_fft2d[p={p},width={d_mlp}]"] = neel_fft2d
+    cases["lines_frame[500x512]"] = frame(plotting.lines_frame, (500, 512))
+    cases["multi_lines_frame[500x4x512]"] = frame(
+        plotting.multi_lines_frame, (500, 4, 512), ["0", "1", "2", "3"]
+    )
+    cases["scatter_frame[500x512]"] = scatter_frame
+    return cases
+
+
+@functools.lru_cache(maxsize=None)
+def suite_setup(name):
+    # Inputs shared by several suite cases, built on first use
+    device = backend.get_device()
+    if name == "model":
+        return suite_model(p, d_model, device)
+    elif name == "train_data":
+        return data.task_datasets("add", device=device)[0]
+    elif name == "mat":
+        return torch.randn(p * p, d_mlp, device=device)
+    raise ValueError(f"Unknown suite input {name}")
+
+
+def settle_allocator():
+    # glibc serves allocations above a dynamic threshold with fresh mmaps, which
+    # page fault on every use, and raises the threshold (up to 32MB) whenever
+    # such a block is freed. Freeing a large block up front puts it at its final
+    # value, so a case's time doesn't depend on which cases ran before it
+    block = np.ones(31 * 2**20, dtype=np.uint8)
+    del block
+
+
+def run_suite(pattern="*"):
+    # Best seconds of every case whose name matches the glob pattern
+    settle_allocator()
+    results = {}
+    for name, setup in suite_cases().items():
+        if fnmatch.fnmatchcase(name, pattern):
+            results[name] = best_time(setup())
+    return results
+
+
+def compare_to_baseline(results, baseline, threshold):
+    # (name, seconds, baseline seconds or None, regressed) for every result
+    rows = []
+    for name, seconds in results.items():
+        base = baseline.get(name)
+        regressed = base is not None and seconds > base * (1 + threshold)
+        rows.append((name, seconds, base, regressed))
+    return rows
+
+
+def validate_amp(
+    amp_dtype="bfloat16", fn_name="add", num_epochs=num_epochs, frac_train=frac_train
+):
+    # Trains the same initial model in full precision and with amp_dtype, and
+    # compares the two runs' loss curves and grokking epochs. Test losses are
+    # only compared up to the full precision run's grokking epoch: below the
+    # grokking loss the test curve is chaotic, and even a 1e-6 perturbation of
+    # the init moves it by a factor of 3 there
+    train_data, test_data = data.task_datasets(fn_name, frac_train)
+    torch.manual_seed(seed)
+    model = train.make_model()
+    previous_amp_dtype = backend.get_amp_dtype()
+    runs = {}
+    try:
+        with tempfile.TemporaryDirectory() as root:
+            for name in [None, amp_dtype]:
+                backend.set_amp_dtype(name)
+                runs[name] = train.run_training(
+                    Path(root),
+                    fn_name,
+                    train_data,
+                    test_data,
+                    copy.deepcopy(model),
+                    num_epochs=num_epochs,
+                    run_name=str(name),
+                    plot=False,
+                )
+    finally:
+        backend.set_amp_dtype(previous_amp_dtype)
+    (base_train, base_test, test_epochs), (amp_train, amp_test, _) = runs.values()
+    grok_epoch = sweep.grok_epoch(base_test, test_epochs, 1e-2)
+
+    def log_loss_gap(amp_losses, base_losses):
+        # Largest gap between the log loss curves, ie the log of the worst ratio
+        return float(np.abs(np.log(amp_losses) - np.log(base_losses)).max())
+
+    num_compared = len(base_test)
+    if grok_epoch is not None:
+        num_compared = test_epochs.index(grok_epoch) + 1
+    return {
+        "train_log_loss_gap": log_loss_gap(amp_train, base_train),
+        "test_log_loss_gap": log_loss_gap(
+            amp_test[:num_compared], base_test[:num_compared]
+        ),
+        "grok_epoch": grok_epoch,
+        "amp_grok_epoch": sweep.grok_epoch(amp_test, test_epochs, 1e-2),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "bench", choices=["epochs", "attention", "fft", "plotting", "amp", "suite"]
+    )
+    parser.add_argument("--device", default=device)
+    parser.add_argument("--threads", type=int, default=num_threads)
+    parser.add_argument("--epochs", type=int, default=200)
+    parser.add_argument("--fn", default="add")
+    parser.add_argument("--compile", action="store_true")
+    parser.add_argument("--width", type=int, default=64)
+    parser.add_argument("--amp_dtype", default="bfloat16")
+    parser.add_argument("--frac_train", type=float, default=frac_train)
+    # Tolerances for the amp validation run
+    parser.add_argument("--log_loss_tol", type=float, default=0.25)
+    parser.add_argument("--grok_epoch_tol", type=int, default=500)
+    # Suite options: which cases to run, where baselines live, the slowdown that
+    # counts as a regression, and whether to overwrite this machine's baseline
+    parser.add_argument("--cases", default="*")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.add_argument("--update_baseline", action="store_true")
+    args = parser.parse_args()
+    backend.configure(args.device, dtype, args.threads)
+    where = f"on {backend.get_device()} ({torch.get_num_threads()} threads)"
+    if args.bench == "epochs":
+        rate = bench_epochs(args.fn, args.epochs, compile=args.compile)
+        print(f"{args.fn} p={p} d_model={d_model} {where}: {rate:.1f} epochs/sec")
+    elif args.bench == "attention":
+        print(f"Attention forward+backward {where}")
+        for batch, hooked, fused in bench_attention():
+            print(
+                f"batch {batch}: einsum {hooked * 1e3:.2f}ms, "
+                f"fused {fused * 1e3:.2f}ms ({hooked / fused:.2f}x)"
+            )
+    elif args.bench == "fft":
+        print(f"2D Fourier transform of [p^2, {args.width}] {where}")
+        for num, dense, fast in bench_fft(width=args.width):
+            print(
+                f"p={num}: einsum {dense * 1e3:.1f}ms, "
+                f"fft {fast * 1e3:.1f}ms ({dense / fast:.2f}x)"
+            )
+    elif args.bench == "plotting":
+        print("animate_* DataFrame construction, 500 snapshots x 512 points")
+        for name, loop_time, vectorized_time in bench_plotting():
+            print(
+                f"{name}: loop {loop_time * 1e3:.1f}ms, "
+                f"vectorized {vectorized_time * 1e3:.1f}ms "
+                f"({loop_time / vectorized_time:.0f}x)"
+            )
+    elif args.bench == "amp":
+        result = validate_amp(args.amp_dtype, args.fn, args.epochs, args.frac_train)
+        print(f"{args.amp_dtype} against {dtype} {where}: {result}")
+        grok_epochs = [result["grok_epoch"], result["amp_grok_epoch"]]
+        if None in grok_epochs:
+            grok_ok = grok_epochs[0] == grok_epochs[1]
+        else:
+            grok_ok = abs(grok_epochs[0] - grok_epochs[1]) <= args.grok_epoch_tol
+        loss_ok = max(result["train_log_loss_gap"], result["test_log_loss_gap"])
+        loss_ok = loss_ok <= args.log_loss_tol
+        print("PASS" if grok_ok and loss_ok else "FAIL")
+    elif args.bench == "suite":
+        key = machine_key()
+        baselines = {}
+        if args.baseline.exists():
+            with open(args.baseline) as f:
+                baselines = json.load(f)
+        results = run_suite(args.cases)
+        rows = compare_to_baseline(results, baselines.get(key, {}), args.threshold)
+        print(key)
+        for name, seconds, base, regressed in rows:
+            line = f"{name}: {seconds * 1e3:.3f}ms"
+            if base is not None:
+                line += f" (baseline {base * 1e3:.3f}ms, {seconds / base:.2f}x)"
+            print(line + (" REGRESSION" if regressed else ""))
+        # Cases without a baseline yet (eg outside an earlier --cases run) get
+        # this run's times; existing ones are only replaced on request
+        baseline = baselines.get(key, {})
+        new_results = {
+            name: seconds
+            for name, seconds in results.items()
+            if args.update_baseline or name not in baseline
+        }
+        if new_results:
+            baselines[key] = {**baseline, **new_results}
+            with open(args.baseline, "w") as f:
+                json.dump(baselines, f, indent=2, sort_keys=True)
+            print(
+                f"Saved baseline of {len(new_results)} cases for this machine to "
+                f"{args.baseline}"
+            )
+        if any(regressed for *_, regressed in rows):
+            raise SystemExit(f"Regressions beyond {args.threshold:.0%}")
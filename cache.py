@@ -0,0 +1,212 @@
+import fnmatch
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import torch
+
+# Selective activation caching. Unlike HookedModel.cache_all, which keeps every
+# HookPoint's full activation in a dict, an ActivationCache only hooks the
+# HookPoints matching some name patterns, can reduce each activation on the fly
+# (see the reducers below) and appends one record per forward pass, either in
+# memory or to append-only files on disk that are read back with np.memmap. So
+# eg blocks.0.mlp.hook_post can be cached over hundreds of checkpoints without
+# holding it all in RAM
+
+
+# Reducers take an activation and return a smaller tensor, or a dict of tensors
+# which are stored as name.key
+def mean_over_batch(tensor):
+    return tensor.mean(dim=0)
+
+
+def project(basis, dim=0):
+    # Coefficients of tensor along dim in the rows of basis, eg a Fourier basis
+    # with dim=0 to take the batch of p^2 inputs into the 2D Fourier basis
+    def reducer(tensor):
+        return torch.movedim(
+            torch.tensordot(tensor, basis.to(tensor), dims=([dim], [1])), -1, dim
+        )
+
+    return reducer
+
+
+def top_k_neurons(k, dim=-1):
+    # Activations of the k neurons along dim with the largest mean absolute
+    # activation, plus which neurons they are
+    def reducer(tensor):
+        neurons = torch.movedim(tensor, dim, -1).reshape(-1, tensor.shape[dim])
+        indices = neurons.abs().mean(dim=0).topk(k).indices
+        return {"values": tensor.index_select(dim, indices), "indices": indices}
+
+    return reducer
+
+
+class MemorySink:
+    # Keeps records as CPU tensors
+    def __init__(self):
+        self.records = {}
+
+    def append(self, name, tensor):
+        self.records.setdefault(name, []).append(tensor)
+
+    def names(self):
+        return list(self.records)
+
+    def read(self, name):
+        return torch.stack(self.records[name])
+
+    def close(self):
+        pass
+
+
+class DiskSink:
+    # Appends each record's raw bytes to directory/name.bin, with shapes,
+    # dtypes and counts in directory/index.json; reading memory-maps the file, so only the
+    # slices actually used are paged in
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.directory / "index.json"
+        self.index = {}
+        if self.index_path.exists():
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        self.files = {}
+
+    def append(self, name, tensor):
+        entry = {"shape": list(tensor.shape), "count": 0}
+        if tensor.dtype == torch.bfloat16:
+            # numpy has no bfloat16, so its bits are stored as int16, and read
+            # back as bfloat16 through the dtype recorded in the index
+            tensor = tensor.view(torch.int16)
+            entry["torch_dtype"] = "bfloat16"
+        array = tensor.numpy()
+        entry["dtype"] = array.dtype.str
+        entry = self.index.setdefault(name, entry)
+        if list(array.shape) != entry["shape"]:
+            raise ValueError(
+                f"{name} has shape {list(array.shape)}, expected {entry['shape']}"
+            )
+        if name not in self.files:
+            self.files[name] = open(self.directory / f"{name}.bin", "ab")
+        self.files[name].write(np.ascontiguousarray(array).tobytes())
+        entry["count"] += 1
+
+    def names(self):
+        return list(self.index)
+
+    def read(self, name):
+        self.flush()
+        entry = self.index[name]
+        # Copy-on-write, so the result is a writable array without loading it
+        array = np.memmap(
+            self.directory / f"{name}.bin",
+            dtype=np.dtype(entry["dtype"]),
+            mode="c",
+            shape=(entry["count"], *entry["shape"]),
+        )
+        tensor = torch.from_numpy(array)
+        if "torch_dtype" in entry:
+            tensor = tensor.view(getattr(torch, entry["torch_dtype"]))
+        return tensor
+
+    def flush(self):
+        for f in self.files.values():
+            f.flush()
+        tmp_path = self.index_path.with_name(".index.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+
+class ActivationCache:
+    # Caches activations of model's HookPoints whose names match any of the glob
+    # patterns in names. reducers maps glob patterns to reducer functions (the
+    # first match applies). Records go to a DiskSink in directory if given, in
+    # dtype, else stay in memory. With incl_bwd, gradients are cached too, as
+    # name_grad. Use as a context manager, or call attach and detach
+    def __init__(
+        self,
+        model,
+        names="*",
+        reducers=None,
+        directory=None,
+        dtype=torch.float32,
+        incl_bwd=False,
+    ):
+        self.model = model
+        self.patterns = [names] if isinstance(names, str) else list(names)
+        self.reducers = reducers or {}
+        self.sink = DiskSink(directory) if directory is not None else MemorySink()
+        self.dtype = dtype
+        self.incl_bwd = incl_bwd
+        self.handles = []
+
+    def hook_points(self):
+        return [
+            hp
+            for hp in self.model.hook_points()
+            if any(fnmatch.fnmatchcase(hp.name, pattern) for pattern in self.patterns)
+        ]
+
+    def reducer(self, name):
+        for pattern, reducer in self.reducers.items():
+            if fnmatch.fnmatchcase(name, pattern):
+                return reducer
+        return None
+
+    def save(self, name, tensor):
+        reducer = self.reducer(name)
+        with torch.no_grad():
+            result = reducer(tensor) if reducer is not None else tensor
+        if not isinstance(result, dict):
+            result = {"": result}
+        for key, value in result.items():
+            record_name = f"{name}.{key}" if key else name
+            value = value.detach().to("cpu")
+            if value.is_floating_point():
+                value = value.to(self.dtype)
+            self.sink.append(record_name, value)
+
+    def attach(self):
+        def save_hook(tensor, name):
+            self.save(name, tensor)
+
+        def save_hook_back(tensor, name):
+            self.save(name + "_grad", tensor[0])
+
+        for hp in self.hook_points():
+            self.handles.append((hp, hp.add_hook(save_hook, "fwd")))
+            if self.incl_bwd:
+                self.handles.append((hp, hp.add_hook(save_hook_back, "bwd")))
+
+    def detach(self):
+        # Only removes this cache's hooks, leaving any others in place
+        for hp, handle in self.handles:
+            hp.remove_hook(handle)
+        self.handles = []
+        self.sink.close()
+
+    def __enter__(self):
+        self.attach()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.detach()
+        return False
+
+    def names(self):
+        return self.sink.names()
+
+    def __getitem__(self, name):
+        # All records of name, stacked along a leading dimension in the order the
+        # forward passes ran
+        return self.sink.read(name)
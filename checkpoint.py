@@ -0,0 +1,95 @@
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+
+import torch
+
+
+def to_cpu(obj):
+    # Snapshot of obj with every tensor detached and copied to the CPU, so the
+    # training loop can keep updating its parameters in place while it is written
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    # Writes to a temporary file next to path and renames it into place, so a
+    # crash mid-write never leaves a truncated checkpoint behind
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class CheckpointWriter:
+    # Saves checkpoints from a background thread so the training loop never
+    # waits on disk. save() snapshots the object to CPU and queues it; once
+    # max_pending snapshots are waiting it blocks until the writer catches up,
+    # which bounds the memory held by pending checkpoints. Used as a context
+    # manager it flushes every pending write on exit, including when the body
+    # raises
+    def __init__(self, max_pending=2):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        # Total time the background thread has spent writing, for instrumentation
+        self.write_seconds = 0.0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                obj, path = item
+                start = time.perf_counter()
+                atomic_save(obj, path)
+                self.write_seconds += time.perf_counter() - start
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Background checkpoint write failed") from error
+
+    def save(self, obj, path, copy=True):
+        # Pass copy=False only for objects the caller will never modify again
+        self._raise_error()
+        self.queue.put((to_cpu(obj) if copy else obj, path))
+
+    def flush(self):
+        # Blocks until every queued checkpoint is on disk
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Still write out what was queued, but don't let a write error mask
+            # the exception that stopped training
+            try:
+                self.close()
+            except RuntimeError:
+                pass
+        return False
@@ -1,51 +1,419 @@
+import atexit
+import functools
+import itertools
 import numpy as np
+import queue
 import random
-from hyperparams import frac_train, p, seed
+import threading
+import torch
 
+import backend
+from hyperparams import frac_train, p, seed, split_shuffle
 
-def gen_train_test(frac_train, num, seed=0):
+
+def gen_train_test_indices(frac_train, num, seed=0, shuffle=split_shuffle):
+    # Generate train and test split as flat indices x * num + y into the grid of
+    # all num^2 pairs, from a seeded permutation of range(num^2). shuffle="legacy"
+    # reproduces the splits of older runs: Python's random.shuffle of a list,
+    # giving exactly the permutation gen_train_test used to apply to the list
+    # of pairs, but taking seconds from p ~ 1000
+    if shuffle == "numpy":
+        perm = np.random.default_rng(seed).permutation(num * num)
+    elif shuffle == "legacy":
+        perm = list(range(num * num))
+        random.seed(seed)
+        random.shuffle(perm)
+        perm = np.array(perm, dtype=np.int64)
+    else:
+        raise ValueError(f"Invalid shuffle {shuffle}")
+    div = int(frac_train * len(perm))
+    return perm[:div], perm[div:]
+
+
+def indices_to_pairs(indices, num):
+    # Converts flat grid indices back into the (x, y, num) tuples used as model
+    # inputs
+    xs, ys = np.divmod(np.asarray(indices), num)
+    return [(x, y, num) for x, y in zip(xs.tolist(), ys.tolist())]
+
+
+def pairs_to_indices(pairs, num):
+    if len(pairs) == 0:
+        return np.zeros(0, dtype=np.int64)
+    pairs = np.asarray(pairs, dtype=np.int64)
+    return pairs[:, 0] * num + pairs[:, 1]
+
+
+def gen_train_test(frac_train, num, seed=0, shuffle=split_shuffle):
     # Generate train and test split
-    pairs = [(i, j, num) for i in range(num) for j in range(num)]
-    random.seed(seed)
-    random.shuffle(pairs)
-    div = int(frac_train * len(pairs))
-    return pairs[:div], pairs[div:]
+    train_idx, test_idx = gen_train_test_indices(frac_train, num, seed, shuffle)
+    return indices_to_pairs(train_idx, num), indices_to_pairs(test_idx, num)
+
+
+# Splits are computed on first use and memoized per (num, frac_train, seed,
+# task, shuffle), so importing this module is free and several moduli can be used side by
+# side in one process
+@functools.lru_cache(maxsize=None)
+def get_split(
+    num=p, frac_train=frac_train, seed=seed, task=None, shuffle=split_shuffle
+):
+    # Train and test flat indices, restricted to the pairs valid for task
+    train_idx, test_idx = gen_train_test_indices(frac_train, num, seed, shuffle)
+    return filter_indices(train_idx, num, task), filter_indices(test_idx, num, task)
+
+
+@functools.lru_cache(maxsize=None)
+def get_pairs(num=p, frac_train=frac_train, seed=seed, task=None):
+    train_idx, test_idx = get_split(num, frac_train, seed, task)
+    return indices_to_pairs(train_idx, num), indices_to_pairs(test_idx, num)
+
+
+@functools.lru_cache(maxsize=None)
+def get_predicate_arrays(num=p, frac_train=frac_train, seed=seed, task=None):
+    train_idx, test_idx = get_split(num, frac_train, seed, task)
+    return make_index_predicate_arrays(train_idx, test_idx, num)
+
+
+# Module attributes kept from when every split was computed at import, now
+# resolved lazily for the default hyperparams
+_LEGACY_TASKS = {
+    "": None,
+    "div_": "div",
+    "non_modular_add_": "non_modular_add",
+    "non_modular_sub_": "non_modular_sub",
+}
+
+
+def __getattr__(name):
+    for prefix, task in _LEGACY_TASKS.items():
+        for i, split in enumerate(["train", "test"]):
+            if name == f"{prefix}{split}":
+                return get_pairs(task=task)[i]
+            if name == f"{prefix}{split}_idx":
+                return get_split(task=task)[i]
+            if name == f"is_{prefix}{split}":
+                return get_predicate_arrays(task=task)[i]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Which pairs of operands x and y (arrays or tensors) are valid inputs for the
+# restricted tasks, elementwise
+def valid_pairs(x, y, num, task=None):
+    if task is None:
+        return x >= 0
+    elif task == "div":
+        return y != 0
+    elif task == "non_modular_add":
+        return x + y < num
+    elif task == "non_modular_sub":
+        return x - y >= 0
+    else:
+        raise ValueError(f"Invalid task {task}")
+
+
+# As a flat Boolean array over the grid of num^2 pairs
+def valid_mask(num, task=None):
+    x, y = np.divmod(np.arange(num * num), num)
+    return valid_pairs(x, y, num, task)
+
+
+def filter_indices(indices, num, task=None):
+    # Keeps the indices valid for task, preserving their shuffled order
+    if task is None:
+        return indices
+    return indices[valid_mask(num, task)[indices]]
 
 
 # Creates an array of Boolean indices according to whether each data point is in
 # train or test
 # Used to index into the big batch of all possible data
+def make_index_predicate_arrays(train_idx, test_idx, num):
+    is_train = np.zeros(num * num, dtype=bool)
+    is_test = np.zeros(num * num, dtype=bool)
+    is_train[train_idx] = True
+    is_test[test_idx] = True
+    return is_train, is_test
+
+
+def make_predicate_arrays(train, test, num=p):
+    return make_index_predicate_arrays(
+        pairs_to_indices(train, num), pairs_to_indices(test, num), num
+    )
+
+
+# Vectorized label functions for each operation, taking tensors of first and
+# second operands
+@functools.lru_cache(maxsize=None)
+def mod_inverse_table(num):
+    # Multiplicative inverse of every residue mod num (num prime), with 0 mapped
+    # to 0 to match util.mod_div. Cached, as minibatches look it up every step
+    return torch.tensor(
+        [pow(b, num - 2, num) for b in range(num)], dtype=torch.long
+    )
+
+
+OPERATIONS = {
+    "add": lambda x, y, num: (x + y) % num,
+    "sub": lambda x, y, num: (x - y) % num,
+    "mult": lambda x, y, num: (x * y) % num,
+    "div": lambda x, y, num: (x * mod_inverse_table(num)[y]) % num,
+    "non_modular_add": lambda x, y, num: x + y,
+    "non_modular_sub": lambda x, y, num: x - y,
+}
+
+# Operations only defined on part of the grid, keyed by the valid_mask task
+RESTRICTED_TASKS = ["div", "non_modular_add", "non_modular_sub"]
+
+# The non-modular operations over the whole grid, with answers of two tokens
+# to be generated one after the other: x + y in base num, high digit first, and
+# x - y as its sign (1 if negative) then its magnitude. Labels are batch x 2.
+# Training on them needs a model with n_ctx >= 4, for the first answer token
+MULTI_DIGIT_OPERATIONS = {
+    "non_modular_add": lambda x, y, num: torch.stack(
+        [(x + y) // num, (x + y) % num], dim=1
+    ),
+    "non_modular_sub": lambda x, y, num: torch.stack(
+        [(x < y).long(), (x - y).abs()], dim=1
+    ),
+}
+
 
+class TaskDataset:
+    # Inputs (x, y, num) and labels for one operation, built once with vectorized
+    # ops and kept as tensors on a single device so the training loop only
+    # indexes them
+    def __init__(self, inputs, labels):
+        self.inputs = inputs
+        self.labels = labels
 
-def make_predicate_arrays(train, test):
-    is_train = []
-    is_test = []
-    for x in range(p):
-        for y in range(p):
-            if (x, y, 113) in train:
-                is_train.append(True)
-                is_test.append(False)
+    @classmethod
+    def from_indices(cls, fn_name, indices, num, device=None, digits=1):
+        device = device or backend.get_device()
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        x, y = indices // num, indices % num
+        inputs = torch.stack([x, y, torch.full_like(x, num)], dim=1)
+        if digits == 1:
+            labels = OPERATIONS[fn_name](x, y, num)
+        else:
+            labels = MULTI_DIGIT_OPERATIONS[fn_name](x, y, num)
+        return cls(inputs.to(device), labels.to(device))
+
+    def __len__(self):
+        return self.inputs.shape[0]
+
+    def __getitem__(self, index):
+        return TaskDataset(self.inputs[index], self.labels[index])
+
+    def to(self, device):
+        return TaskDataset(self.inputs.to(device), self.labels.to(device))
+
+    def epoch_batches(self, batch_size, epoch, seed=seed):
+        # Minibatches covering the dataset once, in an order reshuffled every
+        # epoch
+        generator = torch.Generator().manual_seed(hash((seed, epoch)) % 2**63)
+        order = torch.randperm(len(self), generator=generator).to(self.inputs.device)
+        for start in range(0, len(self), batch_size):
+            yield self[order[start : start + batch_size]]
+
+
+# Streaming data for moduli whose num^2 pairs are too many to materialize. A
+# FeistelPermutation maps positions in [0, num^2) to flat grid indices one
+# batch at a time, and an IndexDataset is the train or test half of those
+# positions, so memory is bounded by the batch rather than the grid
+
+
+class FeistelPermutation:
+    # A seeded pseudorandom permutation of range(size), evaluated elementwise on
+    # int64 tensors of positions. A balanced Feistel network permutes the
+    # smallest even number of bits covering size; positions it maps past size
+    # are mapped again ("cycle walking") until they land inside, which keeps it
+    # a bijection on range(size). size is over a quarter of the permuted range,
+    # so that takes under 4 passes on average
+    def __init__(self, size, seed, rounds=4):
+        self.size = size
+        bits = max(2, (size - 1).bit_length())
+        self.half_bits = (bits + 1) // 2
+        self.mask = (1 << self.half_bits) - 1
+        rng = random.Random(seed)
+        self.keys = [rng.getrandbits(31) for _ in range(rounds)]
+
+    def round_function(self, right, key):
+        # An integer hash of right and key, kept to 31 bits so products fit
+        # in int64
+        h = (right ^ key) & 0x7FFFFFFF
+        h = (h * 0x5BD1E995) & 0x7FFFFFFF
+        h = h ^ (h >> 13)
+        h = (h * 0x1B873593) & 0x7FFFFFFF
+        h = h ^ (h >> 16)
+        return h & self.mask
+
+    def feistel(self, values):
+        left, right = values >> self.half_bits, values & self.mask
+        for key in self.keys:
+            left, right = right, left ^ self.round_function(right, key)
+        return (left << self.half_bits) | right
+
+    def __call__(self, positions):
+        values = self.feistel(positions)
+        outside = values >= self.size
+        while outside.any():
+            values[outside] = self.feistel(values[outside])
+            outside = values >= self.size
+        return values
+
+
+class IndexDataset:
+    # The train or test split of fn_name over the num^2 pairs, without
+    # materializing it. Pairs are listed in the order of a seeded
+    # FeistelPermutation of the grid, with train the first frac_train of it
+    # and test the rest, like gen_train_test_indices though with a different
+    # shuffle. Pairs outside a restricted task still take up positions but are
+    # dropped from batches, which can therefore come out a little short
+    def __init__(self, fn_name, split, frac_train=frac_train, num=p, seed=seed):
+        self.fn_name = fn_name
+        self.num = num
+        self.seed = seed
+        self.frac_train = frac_train
+        self.task = fn_name if fn_name in RESTRICTED_TASKS else None
+        self.permutation = FeistelPermutation(num * num, seed)
+        num_train = int(frac_train * num * num)
+        if split == "train":
+            self.start, self.stop = 0, num_train
+        elif split == "test":
+            self.start, self.stop = num_train, num * num
+        else:
+            raise ValueError(f"Invalid split {split}")
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def to(self, device):
+        # Batches are built on the CPU and moved to the device they're asked for
+        return self
+
+    def batch(self, positions, device=None):
+        # TaskDataset of the valid pairs at positions (offsets into this split)
+        indices = self.permutation(positions + self.start)
+        x, y = indices // self.num, indices % self.num
+        valid = valid_pairs(x, y, self.num, self.task)
+        x, y = x[valid], y[valid]
+        inputs = torch.stack([x, y, torch.full_like(x, self.num)], dim=1)
+        labels = OPERATIONS[self.fn_name](x, y, self.num)
+        device = device or backend.get_device()
+        return TaskDataset(inputs, labels).to(device)
+
+    def sample(self, size, device=None):
+        # The first size pairs of the split, which is a uniformly random sample
+        # since the split's order is a random permutation
+        return self.batch(torch.arange(min(size, len(self))), device)
+
+    def epoch_batches(self, batch_size, epoch, seed=seed, device=None):
+        # Minibatches covering the split once, reshuffled every epoch by a
+        # second permutation over the split's positions
+        order = FeistelPermutation(len(self), hash((self.seed, seed, epoch)))
+        for start in range(0, len(self), batch_size):
+            stop = min(start + batch_size, len(self))
+            yield self.batch(order(torch.arange(start, stop)), device)
+
+
+def background(iterator, lookahead=4):
+    # Yields the items of iterator, which a background thread computes up to
+    # lookahead items ahead of the consumer. Closing the generator, or exiting
+    # the interpreter, stops the thread once it finishes its current item
+    items = queue.Queue(maxsize=lookahead)
+    done = object()
+    stopped = threading.Event()
+
+    def put(item):
+        # Waits for space in the queue, giving up if the consumer has stopped
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterator:
+                if not put(item):
+                    return
+            put(done)
+        except BaseException as e:
+            put(e)
+
+    def stop():
+        stopped.set()
+        thread.join()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    # Otherwise a daemon thread still inside torch at exit aborts the process
+    atexit.register(stop)
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        atexit.unregister(stop)
+        stop()
+
+
+def minibatches(dataset, batch_size, device=None, seed=seed, lookahead=4):
+    # Endless stream of shuffled minibatches of a TaskDataset or IndexDataset,
+    # epoch after epoch, built by a background thread ahead of the training loop
+    device = device or backend.get_device()
+
+    def epochs():
+        for epoch in itertools.count():
+            if isinstance(dataset, IndexDataset):
+                yield from dataset.epoch_batches(batch_size, epoch, seed, device)
             else:
-                is_train.append(False)
-                is_test.append(True)
-    return np.array(is_train), np.array(is_test)
+                yield from dataset.to(device).epoch_batches(batch_size, epoch, seed)
+
+    return background(epochs(), lookahead)
+
+
+def grid_inputs(num=p, device=None):
+    # All num^2 inputs (x, y, num) in flat index order x * num + y
+    indices = torch.arange(num * num)
+    x, y = indices // num, indices % num
+    inputs = torch.stack([x, y, torch.full_like(indices, num)])
+    return inputs.T.contiguous().to(device or backend.get_device())
+
 
+def grid_labels(fn_name, num=p, device=None):
+    # Labels of fn_name over the grid of all num^2 inputs. Pairs outside a
+    # restricted task, whose results can be negative or past the vocabulary, get
+    # label 0 so they can still be indexed, and should be masked out
+    indices = torch.arange(num * num)
+    x, y = indices // num, indices % num
+    labels = OPERATIONS[fn_name](x, y, num)
+    if fn_name in RESTRICTED_TASKS:
+        labels = torch.where(valid_pairs(x, y, num, fn_name), labels, 0)
+    return labels.to(device or backend.get_device())
 
-train, test = gen_train_test(frac_train, p, seed)
 
-div_train = [(x, y, z) for x, y, z in train if y != 0]
-div_test = [(x, y, z) for x, y, z in test if y != 0]
+def task_datasets(
+    fn_name, frac_train=frac_train, num=p, seed=seed, device=None, digits=1
+):
+    # Train and test TaskDatasets for fn_name, restricted to the pairs where the
+    # operation is defined. With digits=2, the MULTI_DIGIT_OPERATIONS version
+    # over the whole grid
+    device = torch.device(device or backend.get_device())
+    return _task_datasets(fn_name, frac_train, num, seed, device, digits)
 
-non_modular_add_train = [(x, y, z) for x, y, z in train if x + y < z]
-non_modular_add_test = [(x, y, z) for x, y, z in test if x + y < z]
-non_modular_sub_train = [(x, y, z) for x, y, z in train if 0 <= x - y < z]
-non_modular_sub_test = [(x, y, z) for x, y, z in test if 0 <= x - y < z]
 
-is_train, is_test = make_predicate_arrays(train, test)
-is_div_train, is_div_test = make_predicate_arrays(div_train, div_test)
-is_non_modular_add_train, is_non_modular_add_test = make_predicate_arrays(
-    non_modular_add_train, non_modular_add_test
-)
-is_non_modular_sub_train, is_non_modular_sub_test = make_predicate_arrays(
-    non_modular_sub_train, non_modular_sub_test
-)
+@functools.lru_cache(maxsize=None)
+def _task_datasets(fn_name, frac_train, num, seed, device, digits):
+    task = fn_name if fn_name in RESTRICTED_TASKS and digits == 1 else None
+    train_idx, test_idx = get_split(num, frac_train, seed, task)
+    return (
+        TaskDataset.from_indices(fn_name, train_idx, num, device, digits),
+        TaskDataset.from_indices(fn_name, test_idx, num, device, digits),
+    )
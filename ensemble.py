@@ -0,0 +1,176 @@
+import copy
+import os
+import time
+
+import numpy as np
+import torch
+from torch.func import functional_call, stack_module_state, vmap
+
+import backend
+import checkpoint
+import data
+from hyperparams import *
+from model import Attention
+import train
+import util
+
+# Trains many independent copies of the model at once. The parameters of every
+# copy are stacked along a leading run dimension and the forward is vmapped over
+# it, so one batched step replaces a Python loop of run_training calls. Each run
+# trains on its own train pairs, padded to the largest run's, so runs can
+# differ in operation, seed and frac_train, and test pairs are only evaluated
+# every eval_every epochs under no_grad, as in run_training. AdamW is
+# elementwise, so a single optimizer over the stacked parameters updates each
+# run exactly as its own optimizer would
+
+
+def run_datasets(run, num=p, device=None):
+    # Train and test TaskDatasets for a run given as a dict with fn_name, seed
+    # and frac_train
+    return data.task_datasets(
+        run["fn_name"],
+        run.get("frac_train", frac_train),
+        num,
+        run.get("seed", seed),
+        device,
+    )
+
+
+def stack_padded(tensors):
+    # [run, size, ...] stack of tensors of different lengths, padded with zeros
+    # (valid tokens) up to the longest. Padding is never scored, see run_losses
+    size = max(len(tensor) for tensor in tensors)
+    padded = []
+    for tensor in tensors:
+        padding = tensor.new_zeros((size - len(tensor),) + tensor.shape[1:])
+        padded.append(torch.cat([tensor, padding]))
+    return torch.stack(padded)
+
+
+def make_ensemble(runs):
+    # One model per run, initialised from the run's seed, and their stacked
+    # parameters and buffers
+    models = []
+    for run in runs:
+        torch.manual_seed(run.get("seed", seed))
+        models.append(train.make_model())
+    params, buffers = stack_module_state(models)
+    # Stateless copy of the architecture to call with the stacked parameters
+    base_model = copy.deepcopy(models[0]).to("meta")
+    # scaled_dot_product_attention has no vmap batching rule and would fall back
+    # to a per-run loop, whereas the einsum path batches into single bmms
+    for module in base_model.modules():
+        if type(module) == Attention:
+            module.use_fused = False
+    return base_model, params, buffers
+
+
+def run_losses(logits, datasets):
+    # Every run's mean cross entropy over its own pairs, ie the first
+    # len(dataset) rows of its [size, vocab] padded logits
+    return torch.stack(
+        [
+            util.cross_entropy_high_precision(logits[i, : len(dataset)], dataset.labels)
+            for i, dataset in enumerate(datasets)
+        ]
+    )
+
+
+def run_state_dict(params, buffers, index):
+    # The state dict of a single run, sliced out of the stacked tensors
+    state_dict = {name: tensor[index] for name, tensor in params.items()}
+    state_dict.update({name: tensor[index] for name, tensor in buffers.items()})
+    return state_dict
+
+
+def run_optimizer_state(optimizer, params, index):
+    # AdamW moments of a single run, keyed by parameter name
+    return {
+        name: {
+            key: value[index] if value.dim() > 0 else value
+            for key, value in optimizer.state[param].items()
+        }
+        for name, param in params.items()
+        if param in optimizer.state
+    }
+
+
+def train_ensemble(root, runs, num_epochs=num_epochs, num=p):
+    # runs is a list of dicts with keys fn_name and optionally seed and
+    # frac_train (defaulting to hyperparams). Returns train losses as an
+    # [epoch, run] array and test losses as a [test epoch, run] array, with the
+    # epochs test losses were measured at, as run_training does
+    device = backend.get_device()
+    base_model, params, buffers = make_ensemble(runs)
+    train_data, test_data = zip(*[run_datasets(run, num, device) for run in runs])
+    train_inputs = stack_padded([dataset.inputs for dataset in train_data])
+    test_inputs = stack_padded([dataset.inputs for dataset in test_data])
+
+    def forward(params, buffers, inputs):
+        return functional_call(base_model, (params, buffers), (inputs,))[:, -1]
+
+    ensemble_forward = vmap(forward)
+    optimizer = torch.optim.AdamW(
+        params.values(), lr=lr, weight_decay=weight_decay, betas=(0.9, 0.98)
+    )
+    scheduler = torch.optim.lr_scheduler.LambdaLR(
+        optimizer, lambda step: min(step / 10, 1)
+    )
+    run_name = f"ensemble_{int(time.time())}"
+    print(f"Run name {run_name}")
+    run_dirs = [root / run_name / f"run_{i}" for i in range(len(runs))]
+    train_losses = []
+    test_losses = []
+    test_epochs = []
+    with checkpoint.CheckpointWriter() as writer:
+        for run_dir, run in zip(run_dirs, runs):
+            os.makedirs(run_dir)
+            writer.save(run, run_dir / "config.pth")
+        for epoch in range(num_epochs):
+            logits = ensemble_forward(params, buffers, train_inputs)
+            train_loss = run_losses(logits, train_data)
+            train_losses.append(train_loss.detach().cpu().numpy())
+            if epoch % eval_every == 0:
+                with torch.no_grad():
+                    logits = ensemble_forward(params, buffers, test_inputs)
+                    test_loss = run_losses(logits, test_data)
+                test_losses.append(test_loss.cpu().numpy())
+                test_epochs.append(epoch)
+            if epoch % 100 == 0:
+                print(
+                    f"\r{epoch}_{np.log(train_losses[-1]).mean():.4f}"
+                    f"_{np.log(test_losses[-1]).mean():.4f}",
+                    end="",
+                )
+            # Each run's loss only depends on its own slice of the parameters,
+            # so the gradient of the sum is every run's own gradient
+            train_loss.sum().backward()
+            optimizer.step()
+            scheduler.step()
+            optimizer.zero_grad()
+            if (test_losses[-1] < stopping_thresh).all():
+                break
+            if save_models and epoch % save_every == 0:
+                for i, run_dir in enumerate(run_dirs):
+                    save_dict = {
+                        "model": run_state_dict(params, buffers, i),
+                        "train_loss": train_loss[i],
+                        "test_loss": test_loss[i],
+                        "epoch": epoch,
+                    }
+                    fn_name = runs[i]["fn_name"]
+                    writer.save(save_dict, run_dir / f"{fn_name}-{epoch}.pth")
+        train_losses = np.stack(train_losses)
+        test_losses = np.stack(test_losses)
+        for i, run_dir in enumerate(run_dirs):
+            save_dict = {
+                "model": run_state_dict(params, buffers, i),
+                "optimizer": run_optimizer_state(optimizer, params, i),
+                "train_losses": train_losses[:, i],
+                "test_losses": test_losses[:, i],
+                "test_epochs": test_epochs,
+                "epoch": epoch,
+            }
+            writer.save(save_dict, run_dir / f"{runs[i]['fn_name']}-final.pth")
+    print(f"\nSaved {len(runs)} runs to {root / run_name}")
+    return train_losses, test_losses, test_epochs
@@ -0,0 +1,112 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+import backend
+from hyperparams import *
+from model import NoMlp, Transformer
+import util
+
+# Whole-grid forwards of Transformer and NoMlp that exploit how small the input
+# space is. Every input is (x, y, num), so before attention the residual stream
+# at position 0 only depends on x, at position 1 only on y, and at position 2
+# is the same for every input. Each position's residual is kept at its
+# broadcast shape (rows x, columns y) of [X, 1, d_model], [1, num, d_model] or
+# [1, 1, d_model], so embeddings and K/Q/V projections are tables over the num
+# tokens rather than num^2 rows, and only positions that attend to both x and y
+# are ever expanded to the grid. Causal attention means position 0 stays a
+# function of x through every layer, and the last layer only computes the
+# answer position
+
+
+def can_factor(model):
+    # Hooks on the model would be bypassed, so those forwards go the usual way
+    return type(model) in (Transformer, NoMlp) and not any(
+        hp.is_active() for hp in model.hook_points()
+    )
+
+
+def embed_positions(model, xs, num, positions):
+    # Residual stream after the token and positional embeddings, at each of
+    # positions, for first operands xs and every second operand
+    W_E = model.embed.W_E.T
+    W_pos = model.pos_embed.W_pos
+    tokens = [W_E[xs][:, None], W_E[:num][None], W_E[num][None, None]]
+    return [tokens[i] + W_pos[i] for i in positions]
+
+
+def attention(attn, resids, positions):
+    # Output of attn at each of positions, where resids is the attention input
+    # at every position up to the last of them. Attention patterns are tiny
+    # ([X, num, num_heads] per key), and the values are only combined once
+    # the pattern has been broadcast over the grid
+    qs = [torch.einsum("ihd,xyd->xyih", attn.W_Q, resid) for resid in resids]
+    ks = [torch.einsum("ihd,xyd->xyih", attn.W_K, resid) for resid in resids]
+    vs = [torch.einsum("ihd,xyd->xyih", attn.W_V, resid) for resid in resids]
+    outs = []
+    for i in positions:
+        scores = [(qs[i] * ks[j]).sum(dim=-1) for j in range(i + 1)]
+        scores = torch.stack(torch.broadcast_tensors(*scores), dim=-1)
+        pattern = F.softmax(scores / np.sqrt(attn.d_head), dim=-1)
+        z = sum(pattern[..., j, None] * vs[j] for j in range(i + 1))
+        outs.append(F.linear(z.flatten(-2), attn.W_O))
+    return outs
+
+
+def block_forward(block, resids, positions):
+    attn_outs = attention(block.attn, resids, positions)
+    outs = []
+    for i, attn_out in zip(positions, attn_outs):
+        resid_mid = resids[i] + attn_out
+        outs.append(resid_mid + block.mlp(resid_mid))
+    return outs
+
+
+def answer_rows(model, xs, num):
+    # Logits at the answer position for inputs (x, y, num) with x in xs, in
+    # grid order, ie [len(xs) * num, d_vocab]
+    # Every layer but the last needs all three positions, as the answer
+    # position attends to each of them
+    positions = [0, 1, 2]
+    resids = embed_positions(model, xs, num, positions)
+    if type(model) == NoMlp:
+        resid = resids[2] + attention(model.attn, resids, [2])[0]
+    else:
+        for layer, block in enumerate(model.blocks):
+            last = layer == len(model.blocks) - 1
+            resids = block_forward(block, resids, [2] if last else positions)
+        resid = resids[-1]
+    resid = resid.expand(len(xs), num, -1)
+    return model.unembed(resid).reshape(len(xs) * num, -1)
+
+
+@torch.no_grad()
+def grid_logits(model, num=p, chunk_size=2**16):
+    # Logits at the answer position for every input, in grid order, equal to
+    # util.answer_logits(model, data.grid_inputs(num)) up to float
+    # rounding. Rows are computed for chunk_size // num first operands at a time
+    device = model.embed.W_E.device
+    rows = max(chunk_size // num, 1)
+    logits = None
+    with backend.autocast():
+        for start in range(0, num, rows):
+            xs = torch.arange(start, min(start + rows, num), device=device)
+            chunk = answer_rows(model, xs, num)
+            if logits is None:
+                logits = chunk.new_empty((num * num, chunk.shape[-1]))
+            logits[start * num : (start + len(xs)) * num] = chunk
+    return logits
+
+
+class FactoredGridEvaluator(util.GridEvaluator):
+    # util.GridEvaluator, with logits from grid_logits for the models it
+    # supports
+    def __init__(self, train_data, test_data, num=p):
+        super().__init__(train_data, test_data, num)
+        self.num = num
+
+    @torch.no_grad()
+    def logits(self, model, chunk_size=2**16):
+        if not can_factor(model):
+            return super().logits(model, chunk_size)
+        return grid_logits(model, self.num, chunk_size)
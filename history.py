@@ -0,0 +1,86 @@
+import torch
+
+
+class SnapshotHistory:
+    # Weight history of a training run, kept as one preallocated CPU tensor per
+    # state dict entry with a leading snapshot dimension, so history[name] is a
+    # [snapshot, ...] tensor that can go straight into plotting.animate_*.
+    # Snapshots are taken every `every` epochs into storage sized to fit in
+    # max_bytes; once it is full, every other snapshot is dropped and the cadence
+    # doubles, so the history always spans the whole run at an even spacing
+    def __init__(self, model, every=100, max_bytes=2**30, dtype=torch.float32):
+        state_dict = model.state_dict()
+        element_size = torch.empty((), dtype=dtype).element_size()
+        snapshot_bytes = sum(t.numel() for t in state_dict.values()) * element_size
+        self.capacity = max(2, int(max_bytes // snapshot_bytes))
+        self.every = every
+        self.count = 0
+        self.epochs = torch.empty(self.capacity, dtype=torch.long)
+        self.snapshots = {
+            name: torch.empty((self.capacity, *t.shape), dtype=dtype)
+            for name, t in state_dict.items()
+        }
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, name):
+        return self.snapshots[name][: self.count]
+
+    def keys(self):
+        return self.snapshots.keys()
+
+    def get_epochs(self):
+        return self.epochs[: self.count]
+
+    def maybe_record(self, model, epoch):
+        if epoch % self.every != 0:
+            return
+        if self.count == self.capacity:
+            self._thin()
+            # The doubled cadence may skip this epoch
+            if epoch % self.every != 0:
+                return
+        self.record(model, epoch)
+
+    def record(self, model, epoch):
+        if self.count == self.capacity:
+            self._thin()
+        with torch.no_grad():
+            for name, t in model.state_dict().items():
+                # copy_ converts device and dtype, so this is a real copy rather
+                # than a reference to the live parameter
+                self.snapshots[name][self.count].copy_(t)
+        self.epochs[self.count] = epoch
+        self.count += 1
+
+    def _thin(self):
+        keep = (self.count + 1) // 2
+        for snapshots in self.snapshots.values():
+            snapshots[:keep] = snapshots[: self.count : 2].clone()
+        self.epochs[:keep] = self.epochs[: self.count : 2].clone()
+        self.count = keep
+        self.every *= 2
+
+    def state_dict(self, index):
+        # The model state dict at snapshot index, in the history's dtype
+        return {name: snapshots[index] for name, snapshots in self.items()}
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+    def to_dict(self):
+        return {
+            "every": self.every,
+            "epochs": self.get_epochs().clone(),
+            "snapshots": {name: snapshots.clone() for name, snapshots in self.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, saved):
+        history = cls.__new__(cls)
+        history.every = saved["every"]
+        history.epochs = saved["epochs"]
+        history.snapshots = saved["snapshots"]
+        history.count = history.capacity = len(history.epochs)
+        return history
@@ -9,11 +9,24 @@ class HookPoint(nn.Module):
         super().__init__()
         self.fwd_hooks = []
         self.bwd_hooks = []
+        # When set, apply_hook skips calling this HookPoint while it has no hooks
+        self.fast_mode = True
 
     def give_name(self, name):
         # Called by the model at initialisation
         self.name = name
 
+    def is_active(self):
+        # Whether calling this HookPoint can do anything beyond returning its
+        # input, ie whether any PyTorch hook is registered on it (whether through
+        # add_hook or directly)
+        return bool(
+            self._forward_hooks
+            or self._forward_pre_hooks
+            or self._backward_hooks
+            or self._backward_pre_hooks
+        )
+
     def add_hook(self, hook, dir="fwd"):
         # Hook format is fn(activation, hook_name)
         # Change it into PyTorch hook format (this includes input and output,
@@ -21,14 +34,23 @@ class HookPoint(nn.Module):
         def full_hook(module, _module_input, module_output):
             return hook(module_output, name=self.name)
 
+        # Backward hooks receive the gradient wrt the output, as a tuple
         if dir == "fwd":
             handle = self.register_forward_hook(full_hook)
             self.fwd_hooks.append(handle)
         elif dir == "bwd":
-            handle = self.register_backward_hook(full_hook)
+            handle = self.register_full_backward_hook(full_hook)
             self.bwd_hooks.append(handle)
         else:
             raise ValueError(f"Invalid direction {dir}")
+        return handle
+
+    def remove_hook(self, handle):
+        # Removes a single hook returned by add_hook
+        handle.remove()
+        for hooks in [self.fwd_hooks, self.bwd_hooks]:
+            if handle in hooks:
+                hooks.remove(handle)
 
     def remove_hooks(self, dir="fwd"):
         if (dir == "fwd") or (dir == "both"):
@@ -44,3 +66,13 @@ class HookPoint(nn.Module):
 
     def forward(self, x):
         return x
+
+
+def apply_hook(hook_point, x):
+    # Equivalent to hook_point(x), but in fast mode an unhooked HookPoint is
+    # skipped entirely rather than dispatched through nn.Module.__call__ only to
+    # return its input. Adding a hook makes it active, so the hooked path comes
+    # back without any extra bookkeeping
+    if hook_point.fast_mode and not hook_point.is_active():
+        return x
+    return hook_point(x)
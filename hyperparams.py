@@ -8,9 +8,46 @@ frac_train = 0.3
 num_epochs = 50000
 save_models = True
 save_every = 100
+# In-run weight history, see history.SnapshotHistory
+snapshot_every = 100
+snapshot_max_bytes = 2**30
+snapshot_dtype = "float32"
+# Test loss and accuracies come from a no_grad forward over the full grid,
+# every eval_every epochs
+eval_every = 10
+# Epochs (start, stop) for run_training to profile with torch.profiler, eg
+# (1000, 1010); None disables profiling
+profile_epochs = None
+# Default cadence of progress.ProgressMeasures callbacks
+progress_every = 100
+# Examples per optimizer step; None trains full-batch. With a batch size every
+# "epoch" of run_training is one step on the next minibatch
+batch_size = None
+# Memory budget in bytes for a training step's activations. Batches needing more
+# are run as micro-batches whose gradients are accumulated into the same step,
+# see util.batch_chunks; None runs every batch in one forward
+max_activation_bytes = None
+# Pairs sampled from each of train and test to evaluate runs streaming a
+# data.IndexDataset, whose full grid is too large to evaluate
+eval_size = 2**14
 # Stop training when test loss is <stopping_thresh
 stopping_thresh = -1
 seed = 0
+# How train/test splits permute the grid: "numpy" (a seeded numpy permutation) or
+# "legacy" (Python's random.shuffle, to reproduce the splits of older runs)
+split_shuffle = "numpy"
+
+# Compute backend, applied by backend.configure
+# None picks cuda when available and falls back to cpu
+device = None
+dtype = "float32"
+# CPU intra-op threads; None uses one per core available to this process
+num_threads = None
+# Autocast dtype for model forwards, eg "bfloat16"; None trains in dtype
+# Not a drop-in: in benchmark.validate_amp at p=47 over 15000 epochs, add
+# grokked at epoch 9840 under bfloat16 against 12470 in float32, so only compare
+# grokking epochs between runs with the same amp_dtype
+amp_dtype = None
 
 num_layers = 1
 d_vocab = p + 1
@@ -21,3 +58,21 @@ assert d_model % num_heads == 0
 d_head = d_model // num_heads
 act_type = "ReLU"  # @param ['ReLU', 'GeLU']
 use_ln = False
+
+
+def override(**values):
+    # Sets hyperparameters for this process, eg in a sweep worker, recomputing
+    # the derived ones unless they are given explicitly. Modules read these with
+    # `from hyperparams import *`, so this must run before they are imported
+    global d_vocab, d_mlp, d_head
+    for name, value in values.items():
+        if name not in globals():
+            raise ValueError(f"Unknown hyperparameter {name}")
+        globals()[name] = value
+    if "d_vocab" not in values:
+        d_vocab = p + 1
+    if "d_mlp" not in values:
+        d_mlp = 4 * d_model
+    if "d_head" not in values:
+        assert d_model % num_heads == 0
+        d_head = d_model // num_heads
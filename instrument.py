@@ -0,0 +1,108 @@
+import json
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+import torch
+
+# Instrumentation for the training loop: wall-clock time per phase of each
+# epoch, written with throughput and peak memory as one JSON object per line,
+# and an optional torch.profiler window exported as a Chrome trace (open it in
+# chrome://tracing or https://ui.perfetto.dev)
+
+
+class PhaseTimer:
+    # Accumulates seconds per named phase until take() is called. On CUDA every
+    # phase boundary synchronizes, so kernels are charged to the phase that
+    # launched them rather than whichever phase next waits on the GPU. Phases
+    # also show up as labelled ranges in profiler traces
+    def __init__(self, device):
+        self.synchronize = device.type == "cuda"
+        self.seconds = {}
+
+    @contextmanager
+    def phase(self, name):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        try:
+            with torch.profiler.record_function(name):
+                yield
+        finally:
+            if self.synchronize:
+                torch.cuda.synchronize()
+            elapsed = time.perf_counter() - start
+            self.seconds[name] = self.seconds.get(name, 0.0) + elapsed
+
+    def take(self):
+        seconds, self.seconds = self.seconds, {}
+        return seconds
+
+
+def peak_memory_bytes(device):
+    # On CUDA, the peak allocated since the last call. On CPU, the process's
+    # peak resident set size, which only ever grows
+    if device.type == "cuda":
+        peak = torch.cuda.max_memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        return peak
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux but bytes on macOS
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+class JsonlLog:
+    # Appends records to path as JSON lines, flushing every flush_every records
+    # and on close, so a crashed run keeps all but its last few records
+    def __init__(self, path, flush_every=100):
+        self.file = open(path, "a")
+        self.flush_every = flush_every
+        self.pending = 0
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.file.flush()
+            self.pending = 0
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+class ProfilerWindow:
+    # Profiles epochs start to stop - 1 with torch.profiler and exports the
+    # trace to path. Call step(epoch) at the start of every epoch, and close()
+    # at the end of training in case it stopped inside the window
+    def __init__(self, start, stop, path):
+        self.start = start
+        self.stop = stop
+        self.path = path
+        self.profiler = None
+
+    def step(self, epoch):
+        if epoch == self.start:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(
+                activities=activities, record_shapes=True, profile_memory=True
+            )
+            self.profiler.__enter__()
+        elif epoch == self.stop:
+            self.close()
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.__exit__(None, None, None)
+            self.profiler.export_chrome_trace(str(self.path))
+            print(f"\nSaved profile of epochs {self.start}-{self.stop} to {self.path}")
+            self.profiler = None
@@ -1,22 +1,9 @@
 import data
-from hyperparams import *
-from model import Transformer
 from pathlib import Path
 import train
 
-model = Transformer(
-    num_layers=num_layers,
-    d_vocab=d_vocab,
-    d_model=d_model,
-    d_mlp=d_mlp,
-    d_head=d_head,
-    num_heads=num_heads,
-    n_ctx=n_ctx,
-    act_type=act_type,
-    use_cache=False,
-    use_ln=use_ln,
-)
-model.to("cuda")
+model = train.make_model()
 
 if __name__ == "__main__":
-    train.run_training(Path("."), "div", data.div_train, data.div_test, model)
+    train_data, test_data = data.task_datasets("div")
+    train.run_training(Path("."), "div", train_data, test_data, model)
@@ -4,7 +4,9 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from hook_point import HookPoint
+import backend
+from cache import ActivationCache
+from hook_point import HookPoint, apply_hook
 
 # From Neel Nanda's A Mechanistic Interpretability Analysis of Grokking
 
@@ -15,9 +17,9 @@ class Embed(nn.Module):
         self.W_E = nn.Parameter(torch.randn(d_model, d_vocab) / np.sqrt(d_model))
 
     def forward(self, x):
-        embedded = self.W_E[:, x]
-        result = torch.einsum("dbp -> bpd", embedded)
-        return result
+        # Gather rows of W_E^T so the result comes out as a contiguous
+        # batch x pos x d_model tensor, rather than a permuted view of W_E[:, x]
+        return F.embedding(x, self.W_E.T)
 
 
 class Unembed(nn.Module):
@@ -26,7 +28,10 @@ class Unembed(nn.Module):
         self.W_U = nn.Parameter(torch.randn(d_model, d_vocab) / np.sqrt(d_vocab))
 
     def forward(self, x):
-        result = x @ self.W_U
+        # Always in the parameters' dtype, outside any autocast: the high
+        # precision loss needs logits with more than bfloat16's 3 digits
+        with torch.autocast(x.device.type, enabled=False):
+            result = x.to(self.W_U.dtype) @ self.W_U
         return result
 
 
@@ -35,8 +40,9 @@ class PosEmbed(nn.Module):
         super().__init__()
         self.W_pos = nn.Parameter(torch.randn(max_ctx, d_model) / np.sqrt(d_model))
 
-    def forward(self, x):
-        result = x + self.W_pos[: x.shape[-2]]
+    def forward(self, x, offset=0):
+        # offset is the position of x's first token, when continuing a sequence
+        result = x + self.W_pos[offset : offset + x.shape[-2]]
         return result
 
 
@@ -76,6 +82,9 @@ class Attention(nn.Module):
         )
         self.register_buffer("mask", torch.tril(torch.ones((n_ctx, n_ctx))))
         self.d_head = d_head
+        # Use the fused scaled_dot_product_attention path whenever none of the
+        # HookPoints below are hooked, since it never materializes them
+        self.use_fused = True
         self.hook_k = HookPoint()
         self.hook_q = HookPoint()
         self.hook_v = HookPoint()
@@ -83,22 +92,83 @@ class Attention(nn.Module):
         self.hook_attn = HookPoint()
         self.hook_attn_pre = HookPoint()
 
-    def forward(self, x):
-        k = self.hook_k(torch.einsum("ihd,bpd->biph", self.W_K, x))
-        q = self.hook_q(torch.einsum("ihd,bpd->biph", self.W_Q, x))
-        v = self.hook_v(torch.einsum("ihd,bpd->biph", self.W_V, x))
+    def hook_points(self):
+        return [
+            self.hook_k,
+            self.hook_q,
+            self.hook_v,
+            self.hook_z,
+            self.hook_attn,
+            self.hook_attn_pre,
+        ]
+
+    def can_fuse(self):
+        return self.use_fused and not any(
+            hp.is_active() for hp in self.hook_points()
+        )
+
+    def forward(self, x, cache=None):
+        if cache is not None:
+            return self.cached_forward(x, cache)
+        if self.can_fuse():
+            return self.fused_forward(x)
+        return self.hooked_forward(x)
+
+    def cached_forward(self, x, cache):
+        # Attention of the new positions x to themselves and to the keys and
+        # values of earlier positions kept in cache (a dict, empty at the start
+        # of a sequence), which x's keys and values are appended to. Like the
+        # fused path it doesn't call the HookPoints
+        W_QKV = torch.cat([self.W_Q, self.W_K, self.W_V], dim=0)
+        qkv = backend.linear(x, W_QKV.reshape(-1, W_QKV.shape[-1]))
+        q, k, v = einops.rearrange(
+            qkv, "b p (three i h) -> three b i p h", three=3, h=self.d_head
+        )
+        if cache:
+            k = torch.cat([cache["k"], k], dim=-2)
+            v = torch.cat([cache["v"], v], dim=-2)
+        cache["k"], cache["v"] = k, v
+        # New position t (of the query's q.shape[-2]) is at offset + t, and
+        # attends to every key up to it
+        offset = k.shape[-2] - q.shape[-2]
+        mask = None
+        if q.shape[-2] > 1:
+            key_pos = torch.arange(k.shape[-2], device=x.device)
+            query_pos = torch.arange(q.shape[-2], device=x.device) + offset
+            mask = key_pos[None, :] <= query_pos[:, None]
+        z = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+        z_flat = einops.rearrange(z, "b i q h -> b q (i h)")
+        return backend.linear(z_flat, self.W_O)
+
+    def fused_forward(self, x):
+        # Single packed QKV projection, then causal attention in one kernel that
+        # never materializes the score or pattern tensors
+        W_QKV = torch.cat([self.W_Q, self.W_K, self.W_V], dim=0)
+        qkv = backend.linear(x, W_QKV.reshape(-1, W_QKV.shape[-1]))
+        q, k, v = einops.rearrange(
+            qkv, "b p (three i h) -> three b i p h", three=3, h=self.d_head
+        )
+        z = F.scaled_dot_product_attention(q, k, v, is_causal=True)
+        z_flat = einops.rearrange(z, "b i q h -> b q (i h)")
+        return backend.linear(z_flat, self.W_O)
+
+    def hooked_forward(self, x):
+        k = apply_hook(self.hook_k, torch.einsum("ihd,bpd->biph", self.W_K, x))
+        q = apply_hook(self.hook_q, torch.einsum("ihd,bpd->biph", self.W_Q, x))
+        v = apply_hook(self.hook_v, torch.einsum("ihd,bpd->biph", self.W_V, x))
         attn_scores_pre = torch.einsum("biph,biqh->biqp", k, q)
         attn_scores_masked = torch.tril(attn_scores_pre) - 1e10 * (
             1 - self.mask[: x.shape[-2], : x.shape[-2]]
         )
-        attn_matrix = self.hook_attn(
-            F.softmax(
-                self.hook_attn_pre(attn_scores_masked / np.sqrt(self.d_head)), dim=-1
-            )
+        attn_scores_scaled = apply_hook(
+            self.hook_attn_pre, attn_scores_masked / np.sqrt(self.d_head)
         )
-        z = self.hook_z(torch.einsum("biph,biqp->biqh", v, attn_matrix))
+        attn_matrix = apply_hook(self.hook_attn, F.softmax(attn_scores_scaled, dim=-1))
+        z = apply_hook(self.hook_z, torch.einsum("biph,biqp->biqh", v, attn_matrix))
         z_flat = einops.rearrange(z, "b i q h -> b q (i h)")
-        out = torch.einsum("df,bqf->bqd", self.W_O, z_flat)
+        # Same as einsum("df,bqf->bqd"), but goes straight to a single GEMM on a
+        # contiguous output
+        out = backend.linear(z_flat, self.W_O)
         return out
 
 
@@ -116,13 +186,15 @@ class MLP(nn.Module):
         assert act_type in ["ReLU", "GeLU"]
 
     def forward(self, x):
-        x = self.hook_pre(torch.einsum("md,bpd->bpm", self.W_in, x) + self.b_in)
+        # F.linear fuses the bias add into the matmul (addmm), which matters on
+        # CPU where the separate broadcast add is a second pass over the tensor
+        x = apply_hook(self.hook_pre, backend.linear(x, self.W_in, self.b_in))
         if self.act_type == "ReLU":
             x = F.relu(x)
         elif self.act_type == "GeLU":
             x = F.gelu(x)
-        x = self.hook_post(x)
-        x = torch.einsum("dm,bpm->bpd", self.W_out, x) + self.b_out
+        x = apply_hook(self.hook_post, x)
+        x = backend.linear(x, self.W_out, self.b_out)
         return x
 
 
@@ -139,14 +211,64 @@ class TransformerBlock(nn.Module):
         self.hook_resid_mid = HookPoint()
         self.hook_resid_post = HookPoint()
 
-    def forward(self, x):
-        x = self.hook_resid_pre(x)
-        x = self.hook_resid_mid(x + self.hook_attn_out(self.attn(x)))
-        x = self.hook_resid_post(x + self.hook_mlp_out(self.mlp(x)))
+    def forward(self, x, cache=None):
+        x = apply_hook(self.hook_resid_pre, x)
+        attn_out = apply_hook(self.hook_attn_out, self.attn(x, cache))
+        x = apply_hook(self.hook_resid_mid, x + attn_out)
+        mlp_out = apply_hook(self.hook_mlp_out, self.mlp(x))
+        x = apply_hook(self.hook_resid_post, x + mlp_out)
         return x
 
 
-class Transformer(nn.Module):
+class HookedModel(nn.Module):
+    # HookPoint management shared by the top-level models
+
+    def name_hook_points(self):
+        # Called by the model at initialisation
+        for name, module in self.named_modules():
+            if type(module) == HookPoint:
+                module.give_name(name)
+
+    def hook_points(self):
+        return [module for name, module in self.named_modules() if "hook" in name]
+
+    def remove_all_hooks(self):
+        for hp in self.hook_points():
+            hp.remove_hooks("fwd")
+            hp.remove_hooks("bwd")
+
+    def cache_activations(self, names="*", **kwargs):
+        # Selective, optionally reduced and disk-backed caching, see
+        # cache.ActivationCache
+        return ActivationCache(self, names, **kwargs)
+
+    def cache_all(self, cache, incl_bwd=False):
+        # Caches all activations wrapped in a HookPoint
+        def save_hook(tensor, name):
+            cache[name] = tensor.detach()
+
+        def save_hook_back(tensor, name):
+            cache[name + "_grad"] = tensor[0].detach()
+
+        for hp in self.hook_points():
+            hp.add_hook(save_hook, "fwd")
+            if incl_bwd:
+                hp.add_hook(save_hook_back, "bwd")
+
+    def set_fast_mode(self, fast_mode=True):
+        # In fast mode (the default) unhooked HookPoints are skipped and Attention
+        # takes its fused path, so forward is plain tensor code that torch.compile
+        # can capture as a single graph. Hooked HookPoints always run, so
+        # cache_all and add_hook work either way. Turning fast mode off calls
+        # every HookPoint and the einsum attention path, as originally written
+        for module in self.modules():
+            if type(module) == HookPoint:
+                module.fast_mode = fast_mode
+            elif type(module) == Attention:
+                module.use_fused = fast_mode
+
+
+class Transformer(HookedModel):
     def __init__(
         self,
         num_layers,
@@ -176,45 +298,60 @@ class Transformer(nn.Module):
         self.unembed = Unembed(d_vocab, d_model)
         self.use_ln = use_ln
 
-        for name, module in self.named_modules():
-            if type(module) == HookPoint:
-                module.give_name(name)
+        self.name_hook_points()
 
     def forward(self, x):
+        # With use_cache, x continues the sequence of the previous calls, whose
+        # keys and values are kept per layer in self.cache, and the logits are
+        # only for x's positions. Otherwise x is a whole sequence
+        offset = 0
+        if self.use_cache and self.cache:
+            offset = self.cache[0]["k"].shape[-2]
+        length = offset + x.shape[-1]
+        n_ctx = self.pos_embed.W_pos.shape[0]
+        if length > n_ctx:
+            raise ValueError(f"Sequence of {length} tokens is past n_ctx={n_ctx}")
         x = self.embed(x)
-        x = self.pos_embed(x)
-        for block in self.blocks:
-            x = block(x)
+        x = self.pos_embed(x, offset)
+        for layer, block in enumerate(self.blocks):
+            cache = self.cache.setdefault(layer, {}) if self.use_cache else None
+            x = block(x, cache)
         # x = self.ln(x)
         x = self.unembed(x)
         return x
 
     def set_use_cache(self, use_cache):
+        # Either way the next forward starts a new sequence
         self.use_cache = use_cache
+        self.cache = {}
 
-    def hook_points(self):
-        return [module for name, module in self.named_modules() if "hook" in name]
-
-    def remove_all_hooks(self):
-        for hp in self.hook_points():
-            hp.remove_hooks("fwd")
-            hp.remove_hooks("bwd")
-
-    def cache_all(self, cache, incl_bwd=False):
-        # Caches all activations wrapped in a HookPoint
-        def save_hook(tensor, name):
-            cache[name] = tensor.detach()
-
-        def save_hook_back(tensor, name):
-            cache[name + "_grad"] = tensor[0].detach()
-
-        for hp in self.hook_points():
-            hp.add_hook(save_hook, "fwd")
-            if incl_bwd:
-                hp.add_hook(save_hook_back, "bwd")
-
-
-class Mlps(nn.Module):
+    @torch.no_grad()
+    def generate(self, inputs, num_tokens):
+        # Greedy continuation of every sequence in the batch inputs by num_tokens
+        # tokens. The prompt runs once, and each new token then only runs its own
+        # position against the cached keys and values, rather than the whole
+        # prefix again
+        # The last token is generated but never fed back in
+        n_ctx = self.pos_embed.W_pos.shape[0]
+        if inputs.shape[1] + num_tokens - 1 > n_ctx:
+            raise ValueError(
+                f"Generating {num_tokens} tokens after {inputs.shape[1]} needs "
+                f"n_ctx >= {inputs.shape[1] + num_tokens - 1}, not {n_ctx}"
+            )
+        use_cache = self.use_cache
+        self.set_use_cache(True)
+        try:
+            logits = self(inputs)[:, -1]
+            tokens = [logits.argmax(dim=-1)]
+            for _ in range(num_tokens - 1):
+                logits = self(tokens[-1][:, None])[:, -1]
+                tokens.append(logits.argmax(dim=-1))
+        finally:
+            self.set_use_cache(use_cache)
+        return torch.stack(tokens, dim=1)
+
+
+class Mlps(HookedModel):
     def __init__(
         self, num_layers, d_vocab, d_model, d_mlp, n_ctx, act_type, use_cache=False
     ):
@@ -230,9 +367,7 @@ class Mlps(nn.Module):
         )
         self.unembed = Unembed(d_vocab, d_model)
 
-        for name, module in self.named_modules():
-            if type(module) == HookPoint:
-                module.give_name(name)
+        self.name_hook_points()
 
     def forward(self, x):
         x = self.embed(x)
@@ -243,7 +378,7 @@ class Mlps(nn.Module):
         return x
 
 
-class NoMlp(nn.Module):
+class NoMlp(HookedModel):
     def __init__(self, d_head, num_heads, d_vocab, d_model, n_ctx):
         super().__init__()
         self.embed = Embed(d_vocab, d_model)
@@ -252,6 +387,8 @@ class NoMlp(nn.Module):
         self.attn = Attention(d_model, num_heads, d_head, n_ctx)
         self.unembed = Unembed(d_vocab, d_model)
 
+        self.name_hook_points()
+
     def forward(self, x):
         x = self.embed(x)
         x = self.pos_embed(x)
@@ -6,13 +6,24 @@ import plotly.express as px
 import plotly.graph_objects as go
 import torch
 
-from util import unflatten_first, neel_fourier_basis_names
+import report
+from util import unflatten_first, get_neel_fourier_basis_names
 from hyperparams import p
 
 # Plotting functions
 # This is mostly a bunch of over-engineered mess to hack Plotly into producing
 # the pretty pictures I want, I recommend not reading too closely unless you
 # want Plotly hacking practice
+def show(fig):
+    # Every helper ends here: figures open with fig.show(), unless a
+    # report.Report is active, which writes them to disk instead
+    active = report.current()
+    if active is not None:
+        active.add(fig)
+    else:
+        fig.show()
+
+
 def to_numpy(tensor, flat=False):
     if type(tensor) != torch.Tensor:
         return tensor
@@ -26,11 +37,12 @@ def imshow_(tensor, xaxis=None, yaxis=None, animation_name="Snapshot", **kwargs)
     if tensor.shape[0] == p * p:
         tensor = unflatten_first(tensor)
     tensor = torch.squeeze(tensor)
-    px.imshow(
+    fig = px.imshow(
         to_numpy(tensor, flat=False),
         labels={"x": xaxis, "y": yaxis, "animation_name": animation_name},
         **kwargs,
-    ).show()
+    )
+    show(fig)
 
 
 # Set default colour scheme
@@ -58,11 +70,11 @@ def line(x, y=None, hover=None, xaxis="", yaxis="", **kwargs):
         x = to_numpy(x, flat=True)
     fig = px.line(x, y=y, hover_name=hover, **kwargs)
     fig.update_layout(xaxis_title=xaxis, yaxis_title=yaxis)
-    fig.show()
+    show(fig)
 
 
 def scatter(x, y, **kwargs):
-    px.scatter(x=to_numpy(x, flat=True), y=to_numpy(y, flat=True), **kwargs).show()
+    show(px.scatter(x=to_numpy(x, flat=True), y=to_numpy(y, flat=True), **kwargs))
 
 
 def lines(
@@ -97,13 +109,41 @@ def lines(
         )
     if log_y:
         fig.update_layout(yaxis_type="log")
-    fig.show()
+    show(fig)
 
 
 def line_marker(x, **kwargs):
     lines([x], mode="lines+markers", **kwargs)
 
 
+def decimate(lines_list, snapshot_index, hover, snapshot_stride, point_stride):
+    # Keeps every snapshot_stride-th snapshot (first dim) and every
+    # point_stride-th point (last dim) of lines_list, along with the matching
+    # snapshot_index entries, the original indices of the points kept (their x
+    # values) and per-point hover labels
+    point_index = np.arange(lines_list.shape[-1])[::point_stride]
+    lines_list = lines_list[::snapshot_stride, ..., ::point_stride]
+    snapshot_index = np.asarray(snapshot_index)[::snapshot_stride]
+    if hover is not None:
+        hover = list(hover)[::point_stride]
+    return lines_list, snapshot_index, point_index, hover
+
+
+def lines_frame(
+    lines_list, snapshot_index, point_index, snapshot="snapshot", xaxis="x", yaxis="y"
+):
+    # Long format DataFrame of a snapshot x point array, with a row per
+    # (snapshot, point) in snapshot-major order and point_index as the x values
+    num_snapshots, num_points = lines_list.shape
+    return pd.DataFrame(
+        {
+            yaxis: lines_list.reshape(-1),
+            snapshot: np.repeat(snapshot_index, num_points),
+            xaxis: np.tile(point_index, num_snapshots),
+        }
+    )
+
+
 def animate_lines(
     lines_list,
     snapshot_index=None,
@@ -111,6 +151,8 @@ def animate_lines(
     hover=None,
     xaxis="x",
     yaxis="y",
+    snapshot_stride=1,
+    point_stride=1,
     **kwargs,
 ):
     if type(lines_list) == list:
@@ -118,15 +160,14 @@ def animate_lines(
     lines_list = to_numpy(lines_list, flat=False)
     if snapshot_index is None:
         snapshot_index = np.arange(lines_list.shape[0])
+    lines_list, snapshot_index, point_index, hover = decimate(
+        lines_list, snapshot_index, hover, snapshot_stride, point_stride
+    )
     if hover is not None:
-        hover = [i for j in range(len(snapshot_index)) for i in hover]
+        hover = hover * len(snapshot_index)
     print(lines_list.shape)
-    rows = []
-    for i in range(lines_list.shape[0]):
-        for j in range(lines_list.shape[1]):
-            rows.append([lines_list[i][j], snapshot_index[i], j])
-    df = pd.DataFrame(rows, columns=[yaxis, snapshot, xaxis])
-    px.line(
+    df = lines_frame(lines_list, snapshot_index, point_index, snapshot, xaxis, yaxis)
+    fig = px.line(
         df,
         x=xaxis,
         y=yaxis,
@@ -134,7 +175,8 @@ def animate_lines(
         range_y=[lines_list.min(), lines_list.max()],
         hover_name=hover,
         **kwargs,
-    ).show()
+    )
+    show(fig)
 
 
 def imshow_fourier(
@@ -168,7 +210,7 @@ def imshow_fourier(
     if facet_labels:
         for i, label in enumerate(facet_labels):
             fig.layout.annotations[i]["text"] = label
-    fig.show()
+    show(fig)
 
 
 def split_imshow_fourier(tensor, animation_frame, title="", animation_name="snapshot"):
@@ -179,6 +221,7 @@ def split_imshow_fourier(tensor, animation_frame, title="", animation_name="snap
     if tensor.shape[0] == p * p:
         tensor = unflatten_first(tensor)
     tensor = torch.squeeze(tensor)
+    neel_fourier_basis_names = get_neel_fourier_basis_names()
 
     # whole graph
     imshow_fourier(
@@ -218,7 +261,7 @@ def split_imshow_fourier(tensor, animation_frame, title="", animation_name="snap
             },
             animation_frame=animation_frame,
         )
-        fig.show()
+        show(fig)
 
     graphs = [
         ("sin left col", sin_slice),
@@ -241,7 +284,7 @@ def split_imshow_fourier(tensor, animation_frame, title="", animation_name="snap
             },
             animation_frame=animation_frame,
         )
-        fig.show()
+        show(fig)
 
     # 4 quadratic term graphs (sin^2, sin*cos, cos*sin, cos^2)
     graphs = [
@@ -268,7 +311,21 @@ def split_imshow_fourier(tensor, animation_frame, title="", animation_name="snap
             animation_frame=animation_frame,
         )
         fig.update(data=[{"hovertemplate": "%{x}x * %{y}y<br>Value:%{z:.4f}"}])
-        fig.show()
+        show(fig)
+
+
+def multi_lines_frame(
+    lines_list, snapshot_index, point_index, y_index, snapshot="snapshot"
+):
+    # Long format DataFrame of a snapshot x line x point array, with a column
+    # per line (named by y_index), a row per (snapshot, point) and point_index
+    # as the x values
+    num_snapshots, _, num_points = lines_list.shape
+    values = lines_list.transpose(0, 2, 1).reshape(num_snapshots * num_points, -1)
+    df = pd.DataFrame(values, columns=y_index)
+    df[snapshot] = np.repeat(snapshot_index, num_points)
+    df["x"] = np.tile(point_index, num_snapshots)
+    return df
 
 
 def animate_multi_lines(
@@ -278,6 +335,8 @@ def animate_multi_lines(
     snapshot="snapshot",
     hover=None,
     swap_y_animate=False,
+    snapshot_stride=1,
+    point_stride=1,
     **kwargs,
 ):
     # Can plot an animation of lines with multiple lines on the plot.
@@ -290,15 +349,14 @@ def animate_multi_lines(
         snapshot_index = np.arange(lines_list.shape[0])
     if y_index is None:
         y_index = [str(i) for i in range(lines_list.shape[1])]
+    lines_list, snapshot_index, point_index, hover = decimate(
+        lines_list, snapshot_index, hover, snapshot_stride, point_stride
+    )
     if hover is not None:
-        hover = [i for j in range(len(snapshot_index)) for i in hover]
+        hover = hover * len(snapshot_index)
     print(lines_list.shape)
-    rows = []
-    for i in range(lines_list.shape[0]):
-        for j in range(lines_list.shape[2]):
-            rows.append(list(lines_list[i, :, j]) + [snapshot_index[i], j])
-    df = pd.DataFrame(rows, columns=y_index + [snapshot, "x"])
-    px.line(
+    df = multi_lines_frame(lines_list, snapshot_index, point_index, y_index, snapshot)
+    fig = px.line(
         df,
         x="x",
         y=y_index,
@@ -306,7 +364,30 @@ def animate_multi_lines(
         range_y=[lines_list.min(), lines_list.max()],
         hover_name=hover,
         **kwargs,
-    ).show()
+    )
+    show(fig)
+
+
+def scatter_frame(
+    lines_list,
+    snapshot_index,
+    color,
+    snapshot="snapshot",
+    xaxis="x",
+    yaxis="y",
+    color_name="color",
+):
+    # Long format DataFrame of a snapshot x 2 x point array of coordinates and a
+    # snapshot x point array of colours, with a row per (snapshot, point)
+    num_points = lines_list.shape[-1]
+    return pd.DataFrame(
+        {
+            xaxis: lines_list[:, 0].reshape(-1).astype(np.float64),
+            yaxis: lines_list[:, 1].reshape(-1).astype(np.float64),
+            snapshot: np.repeat(snapshot_index, num_points),
+            color_name: np.asarray(color).reshape(-1),
+        }
+    )
 
 
 def animate_scatter(
@@ -318,6 +399,8 @@ def animate_scatter(
     xaxis="x",
     color=None,
     color_name="color",
+    snapshot_stride=1,
+    point_stride=1,
     **kwargs,
 ):
     # Can plot an animated scatter plot
@@ -327,30 +410,25 @@ def animate_scatter(
     lines_list = to_numpy(lines_list, flat=False)
     if snapshot_index is None:
         snapshot_index = np.arange(lines_list.shape[0])
-    if hover is not None:
-        hover = [i for j in range(len(snapshot_index)) for i in hover]
     if color is None:
         color = np.ones(lines_list.shape[-1])
     if type(color) == torch.Tensor:
         color = to_numpy(color)
     if len(color.shape) == 1:
         color = einops.repeat(color, "x -> snapshot x", snapshot=lines_list.shape[0])
+    color = color[::snapshot_stride, ::point_stride]
+    lines_list, snapshot_index, _, hover = decimate(
+        lines_list, snapshot_index, hover, snapshot_stride, point_stride
+    )
+    if hover is not None:
+        hover = hover * len(snapshot_index)
     print(lines_list.shape)
-    rows = []
-    for i in range(lines_list.shape[0]):
-        for j in range(lines_list.shape[2]):
-            rows.append(
-                [
-                    lines_list[i, 0, j].item(),
-                    lines_list[i, 1, j].item(),
-                    snapshot_index[i],
-                    color[i, j],
-                ]
-            )
     print([lines_list[:, 0].min(), lines_list[:, 0].max()])
     print([lines_list[:, 1].min(), lines_list[:, 1].max()])
-    df = pd.DataFrame(rows, columns=[xaxis, yaxis, snapshot, color_name])
-    px.scatter(
+    df = scatter_frame(
+        lines_list, snapshot_index, color, snapshot, xaxis, yaxis, color_name
+    )
+    fig = px.scatter(
         df,
         x=xaxis,
         y=yaxis,
@@ -360,4 +438,5 @@ def animate_scatter(
         hover_name=hover,
         color=color_name,
         **kwargs,
-    ).show()
+    )
+    show(fig)
@@ -0,0 +1,80 @@
+import torch
+
+from hyperparams import *
+import util
+
+# Progress measures for grokking, cheap enough to compute during training as
+# run_training callbacks. A callback has an `every` attribute and is called as
+# callback(model, logits, evaluator) every `every` epochs, where logits are the
+# answer logits over the whole grid from evaluator (a util.GridEvaluator),
+# shared with the test metrics when the epochs coincide. It returns a dict of
+# plain Python values (floats, and lists such as ProgressMeasures' key_freqs),
+# which run_training records with the epoch
+
+
+def embed_freq_norms(W_E, num=p):
+    # Squared norm of the token embeddings W_E (d_model x d_vocab) along cos k
+    # and sin k, for every frequency k from 1 to num // 2
+    fourier_basis = util.get_neel_fourier_basis(num, W_E.device, W_E.dtype)
+    coefficients = util.fft1d(fourier_basis, W_E[:, :num])
+    squared = coefficients[:, 1:].pow(2).sum(dim=0)
+    return squared.reshape(num // 2, 2).sum(dim=-1)
+
+
+def xpy_components(logits, freqs, num=p):
+    # The part of grid logits (num^2 x vocab) along cos(freq*(x+y)) and
+    # sin(freq*(x+y)) for each of freqs, with a single projection onto the
+    # cached directions
+    directions = util.get_xpy_directions(num, logits.device, logits.dtype)
+    directions = directions[torch.as_tensor(freqs) - 1].flatten(0, 1)
+    return directions.T @ (directions @ logits)
+
+
+def masked_loss(logits, evaluator, mask):
+    logprobs = util.grid_logprobs(logits, evaluator.labels)
+    return -logprobs[mask].mean().item()
+
+
+class ProgressMeasures:
+    # The measures of Nanda et al.'s grokking progress measures, for the
+    # modular addition circuit:
+    #   restricted_loss: loss over all pairs of the logits' key frequency
+    #     cos/sin(w(x+y)) components alone, with bias correction as in
+    #     util.test_logits
+    #   excluded_loss: train loss with those components removed
+    #   weight_norm: L2 norm of all parameters
+    #   embed_key_frac: fraction of W_E's non-constant Fourier norm in the key
+    #     frequencies, ie how sparse the embedding is in the Fourier basis
+    # key_freqs are fixed if given, else the num_key_freqs frequencies with the
+    # largest W_E norm at each call
+    def __init__(self, every=progress_every, key_freqs=None, num_key_freqs=5, num=p):
+        self.every = every
+        self.key_freqs = key_freqs
+        self.num_key_freqs = num_key_freqs
+        self.num = num
+
+    @torch.no_grad()
+    def __call__(self, model, logits, evaluator):
+        # As in util.test_logits, only the num answer tokens are scored, not "="
+        logits = logits[:, : self.num].float()
+        freq_norms = embed_freq_norms(model.embed.W_E.float(), self.num)
+        if self.key_freqs is None:
+            key_freqs = freq_norms.topk(self.num_key_freqs).indices + 1
+        else:
+            key_freqs = torch.as_tensor(self.key_freqs, device=logits.device)
+        key_components = xpy_components(logits, key_freqs, self.num)
+        restricted_logits = key_components + (logits - key_components).mean(dim=0)
+        weight_norm = sum(param.pow(2).sum() for param in model.parameters())
+        return {
+            "restricted_loss": masked_loss(
+                restricted_logits, evaluator, evaluator.is_train | evaluator.is_test
+            ),
+            "excluded_loss": masked_loss(
+                logits - key_components, evaluator, evaluator.is_train
+            ),
+            "weight_norm": weight_norm.sqrt().item(),
+            "embed_key_frac": (
+                freq_norms[key_freqs - 1].sum() / freq_norms.sum()
+            ).item(),
+            "key_freqs": key_freqs.tolist(),
+        }
@@ -0,0 +1,124 @@
+import concurrent.futures
+import html
+import multiprocessing
+import re
+from pathlib import Path
+
+import plotly.io as pio
+import plotly.offline
+
+import backend
+
+# Renders figures to files rather than opening them, for headless runs. While a
+# Report is active (as a context manager), plotting's helpers hand it their
+# figures instead of calling fig.show(). Figures are serialized by a pool of
+# worker processes, so building the next figure overlaps with writing the last,
+# and every HTML file references one plotly.min.js in the report directory
+# rather than inlining its own ~3MB copy. PNG (or any other image format) needs the
+# optional kaleido package
+
+BUNDLE_NAME = "plotly.min.js"
+# Workers only run plotly code, so fork is safe despite the caller's torch
+# threads, and unlike spawn it doesn't re-import the caller's __main__, which
+# would rerun unguarded scripts like main.py in every worker
+START_METHOD = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+INDEX_NAME = "index.html"
+
+_active = []
+
+
+def current():
+    # The innermost active Report, or None
+    return _active[-1] if _active else None
+
+
+def slugify(text):
+    return re.sub(r"[^a-zA-Z0-9]+", "_", text).strip("_").lower()[:60]
+
+
+def render_figure(fig, stem, formats):
+    # Runs in a worker. fig is a figure dict, already validated when the figure
+    # was built, so it is written without building a go.Figure again
+    paths = []
+    for fmt in formats:
+        path = f"{stem}.{fmt}"
+        if fmt == "html":
+            pio.write_html(
+                fig, path, include_plotlyjs="directory", validate=False, auto_open=False
+            )
+        else:
+            pio.write_image(fig, path, format=fmt, validate=False)
+        paths.append(path)
+    return paths
+
+
+class Report:
+    def __init__(self, directory, formats=("html",), num_workers=None):
+        self.directory = Path(directory)
+        self.formats = list(formats)
+        if any(fmt != "html" for fmt in self.formats):
+            try:
+                import kaleido
+            except ImportError:
+                raise ImportError(
+                    "Writing images needs kaleido, pip install kaleido"
+                ) from None
+        self.num_workers = num_workers or min(4, backend.available_cores())
+        self.executor = None
+        self.futures = []
+        self.names = []
+
+    def add(self, fig, name=None):
+        # Queues fig to be written as directory/NNN-name.{format}, named after
+        # its title by default
+        if self.executor is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            # Written once here, so workers never race to copy it themselves
+            bundle_path = self.directory / BUNDLE_NAME
+            if "html" in self.formats and not bundle_path.exists():
+                bundle_path.write_text(plotly.offline.get_plotlyjs(), encoding="utf-8")
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                self.num_workers, mp_context=multiprocessing.get_context(START_METHOD)
+            )
+        if name is None:
+            name = fig.layout.title.text or "figure"
+        stem = f"{len(self.names):03d}-{slugify(name) or 'figure'}"
+        self.names.append((stem, name))
+        self.futures.append(
+            self.executor.submit(
+                render_figure, fig.to_dict(), str(self.directory / stem), self.formats
+            )
+        )
+
+    def close(self):
+        # Waits for every figure, re-raising the first error, and writes an
+        # index page linking them
+        if self.executor is None:
+            return []
+        try:
+            paths = [path for future in self.futures for path in future.result()]
+        finally:
+            self.executor.shutdown()
+            self.executor = None
+        self.write_index()
+        return paths
+
+    def write_index(self):
+        items = []
+        for stem, name in self.names:
+            links = ", ".join(
+                f'<a href="{stem}.{fmt}">{fmt}</a>' for fmt in self.formats
+            )
+            items.append(f"<li>{html.escape(name)} ({links})</li>")
+        items = "\n".join(items)
+        with open(self.directory / INDEX_NAME, "w") as f:
+            f.write(f"<html><body><ul>\n{items}\n</ul></body></html>\n")
+
+    def __enter__(self):
+        _active.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _active.remove(self)
+        self.close()
+        return False
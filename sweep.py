@@ -0,0 +1,209 @@
+import argparse
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import time
+import traceback
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import torch
+
+import backend
+
+# Runs a grid of hyperparameter configs across a pool of worker processes.
+# Each job runs in a fresh process that applies its config with
+# hyperparams.override before importing train, since the other modules read
+# hyperparams as module constants. Finished jobs are appended to an on-disk
+# ledger, so rerunning the same sweep (with the same number of epochs) skips them
+# and resumes where a crashed sweep stopped
+
+SWEEP_KEYS = ["p", "lr", "weight_decay", "frac_train", "d_model", "fn_name", "seed"]
+LEDGER_NAME = "ledger.jsonl"
+SUMMARY_NAME = "summary.csv"
+
+
+def grid(**axes):
+    # All combinations of the given values, eg grid(seed=[0, 1], p=[97, 113])
+    names = list(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*axes.values())]
+
+
+def job_id(config):
+    # Stable id for a config, used as its run directory and ledger key
+    encoded = json.dumps(config, sort_keys=True).encode()
+    return hashlib.sha1(encoded).hexdigest()[:12]
+
+
+def read_ledger(root):
+    # Latest ledger record for every job id
+    records = {}
+    path = root / LEDGER_NAME
+    if path.exists():
+        with open(path) as f:
+            for line in f:
+                # A crash mid-append can leave a partial last line
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                records[record["job"]] = record
+    return records
+
+
+def append_ledger(root, record):
+    with open(root / LEDGER_NAME, "a") as f:
+        f.write(json.dumps(record) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def grok_epoch(test_losses, test_epochs, grok_loss):
+    # First epoch whose test loss is below grok_loss, or None if it never is
+    below = np.flatnonzero(np.asarray(test_losses) < grok_loss)
+    return test_epochs[below[0]] if len(below) else None
+
+
+def init_worker(device, dtype, num_threads, amp_dtype):
+    # Workers are spawned, so they only see the parent's backend settings
+    # through these arguments
+    backend.configure(device, dtype, num_threads, amp_dtype)
+
+
+def run_job(root, config, num_epochs, grok_loss):
+    # Runs in a fresh worker process; the imports below happen after override so
+    # every module sees this job's hyperparameters
+    import hyperparams
+
+    hyperparams.override(
+        **{k: v for k, v in config.items() if k != "fn_name"}, num_epochs=num_epochs
+    )
+    import data
+    import train
+
+    # Seed the model init as ensemble.make_ensemble does, so a rerun or resumed
+    # job trains the same model; the seed already sets the data split
+    torch.manual_seed(hyperparams.seed)
+    # A job only runs again after a crash or with a different num_epochs, and
+    # the checkpoints and log of that attempt would mix with this one's
+    shutil.rmtree(root / job_id(config), ignore_errors=True)
+    start = time.perf_counter()
+    train_data, test_data = data.task_datasets(config["fn_name"])
+    train_losses, test_losses, test_epochs = train.run_training(
+        root,
+        config["fn_name"],
+        train_data,
+        test_data,
+        None,
+        num_epochs=num_epochs,
+        run_name=job_id(config),
+        plot=False,
+    )
+    return {
+        "grok_epoch": grok_epoch(test_losses, test_epochs, grok_loss),
+        "epochs": len(train_losses),
+        "final_train_loss": train_losses[-1],
+        "final_test_loss": test_losses[-1],
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def write_summary(root, configs):
+    records = read_ledger(root)
+    rows = []
+    for config in configs:
+        record = records.get(job_id(config), {})
+        status = record.get("status", "pending")
+        rows.append({**config, "status": status, **record.get("result", {})})
+    summary = pd.DataFrame(rows)
+    summary.to_csv(root / SUMMARY_NAME, index=False)
+    return summary
+
+
+def run_sweep(
+    root,
+    configs,
+    num_workers=None,
+    num_epochs=None,
+    grok_loss=1e-2,
+):
+    # Runs every config not already marked done in root's ledger, then writes
+    # and returns a summary table with time to grok per config
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    if num_epochs is None:
+        import hyperparams
+
+        num_epochs = hyperparams.num_epochs
+    num_workers = num_workers or backend.available_cores()
+    # Split the cores between workers so they don't oversubscribe the machine
+    num_threads = max(1, backend.available_cores() // num_workers)
+    # A job only counts as done if it ran for as many epochs as asked for now,
+    # so rerunning a sweep with more epochs reruns its shorter jobs
+    done = {
+        job
+        for job, record in read_ledger(root).items()
+        if record["status"] == "done" and record.get("num_epochs") == num_epochs
+    }
+    pending = [config for config in configs if job_id(config) not in done]
+    print(f"{len(configs) - len(pending)} jobs already done, {len(pending)} to run")
+    # spawn plus one task per child gives every job a clean interpreter, which
+    # the module-level hyperparams require
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(
+            str(backend.get_device()),
+            backend.get_dtype(),
+            num_threads,
+            backend.get_amp_dtype(),
+        ),
+        max_tasks_per_child=1,
+    ) as executor:
+        futures = {
+            executor.submit(run_job, root, config, num_epochs, grok_loss): config
+            for config in pending
+        }
+        for future in concurrent.futures.as_completed(futures):
+            config = futures[future]
+            record = {"job": job_id(config), "config": config, "num_epochs": num_epochs}
+            try:
+                record.update(status="done", result=future.result())
+            except Exception:
+                record.update(status="failed", error=traceback.format_exc())
+            append_ledger(root, record)
+            print(f"{record['job']} {record['status']}: {config}")
+    return write_summary(root, configs)
+
+
+if __name__ == "__main__":
+    import hyperparams
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("root", type=Path)
+    parser.add_argument("--p", type=int, nargs="+", default=[hyperparams.p])
+    parser.add_argument("--lr", type=float, nargs="+", default=[hyperparams.lr])
+    parser.add_argument(
+        "--weight_decay", type=float, nargs="+", default=[hyperparams.weight_decay]
+    )
+    parser.add_argument(
+        "--frac_train", type=float, nargs="+", default=[hyperparams.frac_train]
+    )
+    parser.add_argument(
+        "--d_model", type=int, nargs="+", default=[hyperparams.d_model]
+    )
+    parser.add_argument("--fn_name", nargs="+", default=["add"])
+    parser.add_argument("--seed", type=int, nargs="+", default=[hyperparams.seed])
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--epochs", type=int, default=hyperparams.num_epochs)
+    parser.add_argument("--grok_loss", type=float, default=1e-2)
+    args = parser.parse_args()
+    configs = grid(**{key: getattr(args, key) for key in SWEEP_KEYS})
+    summary = run_sweep(args.root, configs, args.workers, args.epochs, args.grok_loss)
+    print(summary.to_string())
@@ -6,103 +6,274 @@ import einops
 import torch
 import torch.optim as optim
 
+import backend
+import checkpoint
+import data
+import factored
+from history import SnapshotHistory
+import instrument
 from model import Mlps, NoMlp, Transformer
 import plotting
 from hyperparams import *
+import report
 import util
 
 
-def run_training(
-    root, fn_name, fn, train_data, test_data, model, num_epochs=num_epochs
-):
-    if model is None:
-        model = Transformer(
-            num_layers=num_layers,
-            d_vocab=d_vocab,
-            d_model=d_model,
-            d_mlp=d_mlp,
-            d_head=d_head,
-            num_heads=num_heads,
-            n_ctx=n_ctx,
-            act_type=act_type,
-            use_cache=False,
-            use_ln=use_ln,
-        )
+def make_model():
+    # The Transformer described by hyperparams, on the configured backend
+    model = Transformer(
+        num_layers=num_layers,
+        d_vocab=d_vocab,
+        d_model=d_model,
+        d_mlp=d_mlp,
+        d_head=d_head,
+        num_heads=num_heads,
+        n_ctx=n_ctx,
+        act_type=act_type,
+        use_cache=False,
+        use_ln=use_ln,
+    )
+    return model.to(device=backend.get_device(), dtype=backend.get_dtype())
+
 
-    model.to("cuda")
+def make_optimizer(model):
     optimizer = optim.AdamW(
         model.parameters(), lr=lr, weight_decay=weight_decay, betas=(0.9, 0.98)
     )
     scheduler = optim.lr_scheduler.LambdaLR(optimizer, lambda step: min(step / 10, 1))
-    run_name = f"grok_{int(time.time())}"
+    return optimizer, scheduler
+
+
+def run_training(
+    root,
+    fn_name,
+    train_data,
+    test_data,
+    model,
+    num_epochs=num_epochs,
+    run_name=None,
+    plot=True,
+    callbacks=(),
+    profile_epochs=profile_epochs,
+    batch_size=batch_size,
+    max_activation_bytes=max_activation_bytes,
+    digits=1,
+):
+    # train_data and test_data are data.TaskDatasets for the operation fn_name,
+    # or data.IndexDatasets for moduli too large to materialize, which need a
+    # batch_size and are evaluated on a sample (see util.SampleEvaluator)
+    # With a batch_size every epoch is one step on the next shuffled minibatch
+    # Batches whose activations would exceed max_activation_bytes are split into
+    # micro-batches with their gradients accumulated, giving the same step
+    # digits is the number of answer tokens, eg 2 for data.task_datasets(...,
+    # digits=2), which are trained with teacher forcing and evaluated by
+    # util.MultiDigitEvaluator
+    # callbacks are run on the grid logits at their own cadence, eg
+    # progress.ProgressMeasures, and their results saved as the run's progress
+    # Per-epoch timings go to {fn_name}-log.jsonl in the run directory, and
+    # profile_epochs=(start, stop) saves a profiler trace of those epochs
+    # Returns the per-epoch train losses, and the test losses with the epochs
+    # they were measured at
+    if model is None:
+        model = make_model()
+    streaming = isinstance(train_data, data.IndexDataset)
+    if streaming and batch_size is None:
+        raise ValueError("Training on an IndexDataset needs a batch_size")
+    if streaming and digits > 1:
+        raise ValueError("IndexDatasets only have single-token answers")
+    if (streaming or digits > 1) and callbacks:
+        raise ValueError("Callbacks need grid logits, which this run lacks")
+
+    device = backend.get_device()
+    model.to(device=device, dtype=backend.get_dtype())
+    train_data = train_data.to(device)
+    test_data = test_data.to(device)
+    optimizer, scheduler = make_optimizer(model)
+    run_name = run_name or f"grok_{int(time.time())}"
     print(f"Run name {run_name}")
-    if save_models:
-        os.mkdir(root / run_name)
+    os.makedirs(root / run_name, exist_ok=True)
+    timer = instrument.PhaseTimer(device)
+    profiler = None
+    if profile_epochs is not None:
+        trace_path = root / run_name / f"{fn_name}-trace.json"
+        profiler = instrument.ProfilerWindow(*profile_epochs, trace_path)
+    # Checkpoints are written by a background thread; leaving the with block
+    # (normally or through an exception) waits for pending writes to finish.
+    # The log gets a record of where the time went in every epoch
+    with checkpoint.CheckpointWriter() as writer, instrument.JsonlLog(
+        root / run_name / f"{fn_name}-log.jsonl"
+    ) as log:
+        if save_models:
+            save_dict = {"model": model.state_dict()}
+            if streaming:
+                # The split is determined by its permutation's seed
+                save_dict["split"] = {
+                    "num": train_data.num,
+                    "seed": train_data.seed,
+                    "frac_train": train_data.frac_train,
+                }
+            else:
+                save_dict["train_data"] = train_data.inputs.cpu()
+                save_dict["test_data"] = test_data.inputs.cpu()
+            writer.save(save_dict, root / run_name / f"{fn_name}-init.pth")
+        if streaming:
+            evaluator = util.SampleEvaluator(train_data, test_data, device=device)
+        elif digits > 1:
+            evaluator = util.MultiDigitEvaluator(train_data, test_data)
+        else:
+            # The grid the datasets were built over, eg num=23 in a process
+            # whose p is 113, rather than the hyperparams' p
+            num = int(train_data.inputs[0, 2])
+            evaluator = factored.FactoredGridEvaluator(train_data, test_data, num)
+        batches = None
+        if batch_size is not None:
+            batches = data.minibatches(train_data, batch_size, device)
+        probe = train_data.sample(256, device) if streaming else train_data
+        chunk_size = util.grad_chunk_size(model, probe, max_activation_bytes, digits)
+        if chunk_size is not None:
+            print(f"Accumulating gradients over chunks of {chunk_size} examples")
+        # train_losses has an entry per epoch; test_losses and the accuracies
+        # are only measured every eval_every epochs, listed in test_epochs
+        train_losses = []
+        test_losses = []
+        test_epochs = []
+        train_accs = []
+        test_accs = []
+        # One {"epoch": epoch, **results} row per epoch any callback ran
+        progress = []
+        history = SnapshotHistory(
+            model,
+            every=snapshot_every,
+            max_bytes=snapshot_max_bytes,
+            dtype=getattr(torch, snapshot_dtype),
+        )
+        for epoch in range(num_epochs):
+            if profiler is not None:
+                profiler.step(epoch)
+            epoch_start = time.perf_counter()
+            write_seconds = writer.write_seconds
+            batch = train_data
+            if batches is not None:
+                # Usually prefetched already, so this only waits if building
+                # batches falls behind training
+                with timer.phase("data"):
+                    batch = next(batches)
+            # Each chunk is backpropagated before the next one's forward, so
+            # only one chunk's activations are alive at a time. Evaluation below
+            # doesn't touch the gradients, and the weights don't change until
+            # the optimizer step, so this is the same step as one forward and
+            # backward over the whole batch
+            train_loss = 0.0
+            for chunk, weight in util.batch_chunks(batch, chunk_size):
+                with timer.phase("forward"):
+                    inputs = util.answer_inputs(chunk, digits)
+                    logits = util.answer_logits(model, inputs, digits)
+                with timer.phase("loss"):
+                    chunk_loss = util.answer_loss(logits, chunk.labels) * weight
+                with timer.phase("backward"):
+                    chunk_loss.backward()
+                train_loss = train_loss + chunk_loss.detach()
+            train_losses.append(train_loss.item())
+            # Grid logits are computed at most once per epoch, and shared by the
+            # test metrics and callbacks
+            grid_logits = None
+            if epoch % eval_every == 0:
+                with timer.phase("eval"):
+                    grid_logits = evaluator.logits(model)
+                    metrics = evaluator.metrics(grid_logits)
+                test_loss = metrics["test_loss"]
+                test_losses.append(test_loss)
+                test_epochs.append(epoch)
+                train_accs.append(metrics["train_acc"])
+                test_accs.append(metrics["test_acc"])
+            results = {}
+            for callback in callbacks:
+                if epoch % callback.every == 0:
+                    with timer.phase("callbacks"):
+                        if grid_logits is None:
+                            grid_logits = evaluator.logits(model)
+                        results.update(callback(model, grid_logits, evaluator))
+            if results:
+                progress.append({"epoch": epoch, **results})
+            with timer.phase("snapshot"):
+                history.maybe_record(model, epoch)
+            if epoch % 100 == 0:
+                log_train_loss = np.log(train_losses[-1])
+                print(f"\r{epoch}_{log_train_loss:.4f}_{np.log(test_loss):.4f}", end="")
+                # print(f"{epoch}_{np.log(train_loss.item()):.4f}_{np.log(test_loss.item()):.4f}")#_{train_acc.item():.4f}_{test_acc.item():.4f}")
+            with timer.phase("optimizer"):
+                optimizer.step()
+                scheduler.step()
+                optimizer.zero_grad()
+            if test_loss < stopping_thresh:
+                break
+            if (save_models) and (epoch % save_every == 0):
+                # Only the snapshot to CPU and enqueueing (or waiting on a full
+                # queue) happen here; the write itself is checkpoint_write
+                with timer.phase("checkpoint"):
+                    save_dict = {
+                        "model": model.state_dict(),
+                        "optimizer": optimizer.state_dict(),
+                        "scheduler": scheduler.state_dict(),
+                        "train_loss": train_loss,
+                        "test_loss": test_loss,
+                        "epoch": epoch,
+                    }
+                    path = root / run_name / f"{fn_name}-{epoch}.pth"
+                    writer.save(save_dict, path)
+                # print(f"Saved model to {root/run_name/f'{fn_name}-{epoch}.pth'}")
+            epoch_seconds = time.perf_counter() - epoch_start
+            record = {"epoch": epoch, "train_loss": train_losses[-1]}
+            for phase, seconds in timer.take().items():
+                record[f"{phase}_seconds"] = seconds
+            # Background writes overlap training, so aren't part of the epoch
+            record["checkpoint_write_seconds"] = writer.write_seconds - write_seconds
+            record["epoch_seconds"] = epoch_seconds
+            record["examples_per_sec"] = len(batch) / epoch_seconds
+            record["peak_memory_bytes"] = instrument.peak_memory_bytes(device)
+            log.write(record)
+        if profiler is not None:
+            profiler.close()
+        if batches is not None:
+            batches.close()
         save_dict = {
             "model": model.state_dict(),
-            "train_data": train_data,
-            "test_data": test_data,
-        }
-        torch.save(save_dict, root / run_name / f"{fn_name}-init.pth")
-    train_losses = []
-    test_losses = []
-    epochs = []
-    state_dicts = []
-    for epoch in range(num_epochs):
-        train_loss = util.full_loss(fn, model, train_data)
-        test_loss = util.full_loss(fn, model, test_data)
-        train_losses.append(train_loss.item())
-        test_losses.append(test_loss.item())
-        if epoch % 100 == 0:
-            epochs.append(epoch)
-            state_dicts.append(model.state_dict())
-            print(
-                f"\r{epoch}_{np.log(train_loss.item()):.4f}_{np.log(test_loss.item()):.4f}",
-                end="",
-            )
-            # print(f"{epoch}_{np.log(train_loss.item()):.4f}_{np.log(test_loss.item()):.4f}")#_{train_acc.item():.4f}_{test_acc.item():.4f}")
-        train_loss.backward()
-        optimizer.step()
-        scheduler.step()
-        optimizer.zero_grad()
-        if test_loss.item() < stopping_thresh:
-            break
-        if (save_models) and (epoch % save_every == 0):
-            if test_loss.item() < stopping_thresh:
-                break
-            save_dict = {
-                "model": model.state_dict(),
-                "optimizer": optimizer.state_dict(),
-                "scheduler": scheduler.state_dict(),
-                "train_loss": train_loss,
-                "test_loss": test_loss,
-                "epoch": epoch,
-            }
-            torch.save(save_dict, root / run_name / f"{fn_name}-{epoch}.pth")
-            # print(f"Saved model to {root/run_name/f'{fn_name}-{epoch}.pth'}")
-    if not save_models:
-        os.mkdir(root / run_name)
-    save_dict = {
-        "model": model.state_dict(),
-        "optimizer": optimizer.state_dict(),
-        "scheduler": scheduler.state_dict(),
-        "train_loss": train_loss,
-        "test_loss": test_loss,
-        "train_losses": train_losses,
-        "test_losses": test_losses,
-        "epoch": epoch,
-    }
-    torch.save(save_dict, root / run_name / f"{fn_name}-final.pth")
-    print(f"Saved final model to {root/run_name/f'{fn_name}-final.pth'}")
-    torch.save(
-        {
+            "optimizer": optimizer.state_dict(),
+            "scheduler": scheduler.state_dict(),
+            "train_loss": train_loss,
+            "test_loss": test_loss,
             "train_losses": train_losses,
             "test_losses": test_losses,
-            "epochs": epochs,
-            "state_dicts": state_dicts,
-            "model": model,
-            # 'config': lr, p, etc
-        },
-        root / run_name / f"{fn_name}-full-run.pth",
-    )
-    plotting.lines([train_losses, test_losses], labels=["train", "test"], log_y=True)
+            "test_epochs": test_epochs,
+            "epoch": epoch,
+        }
+        writer.save(save_dict, root / run_name / f"{fn_name}-final.pth")
+        writer.save(
+            {
+                "train_losses": train_losses,
+                "test_losses": test_losses,
+                "test_epochs": test_epochs,
+                "train_accs": train_accs,
+                "test_accs": test_accs,
+                "progress": progress,
+                "history": history.to_dict(),
+                "model": model,
+                # 'config': lr, p, etc
+            },
+            root / run_name / f"{fn_name}-full-run.pth",
+            copy=False,
+        )
+    print(f"Saved final model to {root/run_name/f'{fn_name}-final.pth'}")
+    if plot:
+        # Written to the run directory rather than shown, so headless runs
+        # don't block or fail here
+        with report.Report(root / run_name / "report"):
+            plotting.lines(
+                [np.array(train_losses)[test_epochs], test_losses],
+                x=test_epochs,
+                labels=["train", "test"],
+                log_y=True,
+                title=f"{fn_name} loss",
+            )
+        print(f"Saved loss curves to {root/run_name/'report'}")
+    return train_losses, test_losses, test_epochs
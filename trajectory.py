@@ -0,0 +1,216 @@
+import concurrent.futures
+import copy
+import fnmatch
+import re
+from pathlib import Path
+
+import torch
+from torch.func import functional_call, vmap
+
+import backend
+import data
+from hyperparams import *
+from model import Attention
+import util
+
+# Loads the periodic {fn_name}-{epoch}.pth checkpoints of a run as one
+# trajectory, with every state dict entry stacked along a leading checkpoint
+# dimension, and evaluates many checkpoints at once with a forward vmapped over
+# that dimension. Files are read by a thread pool a few checkpoints ahead of the
+# one being stacked, and memory-mapped so only the model weights are paged in,
+# not the optimizer state saved next to them
+
+CHECKPOINT_PATTERN = re.compile(r"(?P<fn_name>.+)-(?P<epoch>\d+)\.pth")
+
+
+def checkpoint_paths(run_dir, fn_name=None):
+    # (epoch, path) of every periodic checkpoint in run_dir, in epoch order.
+    # The init, final and full-run files are not numbered, so never match
+    paths = []
+    for path in Path(run_dir).iterdir():
+        match = CHECKPOINT_PATTERN.fullmatch(path.name)
+        if match and fn_name in [None, match["fn_name"]]:
+            paths.append((int(match["epoch"]), path))
+    return sorted(paths)
+
+
+def load_weights(path):
+    # The model state dict of a checkpoint. mmap means storages that are never
+    # touched, eg the optimizer's moments, are never read from disk; cloning
+    # detaches the weights from the file
+    saved = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    return {name: tensor.clone() for name, tensor in saved["model"].items()}
+
+
+def prefetch(fn, items, num_workers=4, lookahead=8):
+    # Yields fn(item) for every item in order, running fn on a thread pool at
+    # most lookahead items ahead of the consumer, which bounds the memory held
+    # by loaded but unconsumed results
+    items = list(items)
+    with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+        futures = {}
+        for i in range(len(items)):
+            for j in range(i, min(i + lookahead, len(items))):
+                if j not in futures:
+                    futures[j] = executor.submit(fn, items[j])
+            yield futures.pop(i).result()
+
+
+class Trajectory:
+    # The weights of a run at each of its checkpoint epochs: params maps every
+    # state dict name to a [checkpoint, ...] tensor
+    def __init__(self, epochs, params):
+        self.epochs = epochs
+        self.params = params
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def __getitem__(self, index):
+        # A sub-trajectory, eg trajectory[::10] or trajectory[-50:]
+        if isinstance(index, int):
+            index = slice(index, index + 1 or None)
+        return Trajectory(
+            self.epochs[index],
+            {name: tensor[index] for name, tensor in self.params.items()},
+        )
+
+    def state_dict(self, index):
+        return {name: tensor[index] for name, tensor in self.params.items()}
+
+    @classmethod
+    def load(cls, run_dir, fn_name=None, every=1, num_workers=4):
+        # Every every-th checkpoint of run_dir. The stacked tensors are
+        # allocated once the first checkpoint arrives and filled in place, so
+        # peak memory is the trajectory plus the prefetched checkpoints
+        paths = checkpoint_paths(run_dir, fn_name)[::every]
+        if not paths:
+            raise FileNotFoundError(f"No checkpoints found in {run_dir}")
+        epochs = torch.tensor([epoch for epoch, _ in paths])
+        params = None
+        loaded = prefetch(load_weights, [path for _, path in paths], num_workers)
+        for i, state_dict in enumerate(loaded):
+            if params is None:
+                params = {
+                    name: torch.empty((len(paths), *t.shape), dtype=t.dtype)
+                    for name, t in state_dict.items()
+                }
+            for name, t in state_dict.items():
+                params[name][i] = t
+        return cls(epochs, params)
+
+
+def run_evaluator(run_dir, fn_name, num=p, device=None):
+    # A util.GridEvaluator with the run's own train/test split, read from its
+    # init checkpoint, else the split for the current hyperparams. Streaming
+    # runs get a util.SampleEvaluator
+    device = device or backend.get_device()
+    init_path = Path(run_dir) / f"{fn_name}-init.pth"
+    if not init_path.exists():
+        train_data, test_data = data.task_datasets(fn_name, num=num, device=device)
+        return util.GridEvaluator(train_data, test_data, num)
+    saved = torch.load(init_path, map_location="cpu", mmap=True, weights_only=True)
+    if "split" in saved:
+        # A streaming run, which saved the seed of its data.IndexDataset split
+        # rather than its pairs, evaluated on a sample as during training
+        split = saved["split"]
+        train_data, test_data = [
+            data.IndexDataset(
+                fn_name, name, split["frac_train"], split["num"], split["seed"]
+            )
+            for name in ["train", "test"]
+        ]
+        return util.SampleEvaluator(train_data, test_data, device=device)
+    labels = data.grid_labels(fn_name, num, "cpu")
+    datasets = []
+    for inputs in [saved["train_data"], saved["test_data"]]:
+        indices = inputs[:, 0] * num + inputs[:, 1]
+        datasets.append(data.TaskDataset(inputs, labels[indices]).to(device))
+    return util.GridEvaluator(*datasets, num)
+
+
+def evaluate_trajectory(
+    model,
+    trajectory,
+    evaluator,
+    names=(),
+    reducers=None,
+    chunk_size=16,
+    return_logits=True,
+):
+    # Evaluates every checkpoint of trajectory on evaluator's p^2 grid with one
+    # forward vmapped over chunk_size checkpoints at a time. model gives the
+    # architecture only. Returns a dict of CPU tensors with a leading checkpoint
+    # dimension: train/test loss and accuracy, the logits at the answer
+    # position if return_logits, and the activations of HookPoints matching the
+    # glob patterns in names. reducers maps glob patterns to functions applied
+    # to each checkpoint's activation, as in cache.ActivationCache, to keep
+    # eg [p^2, d_mlp] neuron activations down to what is needed
+    device = evaluator.inputs.device
+    patterns = [names] if isinstance(names, str) else list(names)
+    reducers = reducers or {}
+    base_model = copy.deepcopy(model).to("meta")
+    # scaled_dot_product_attention has no vmap batching rule, see ensemble.py
+    for module in base_model.modules():
+        if type(module) == Attention:
+            module.use_fused = False
+    activations = {}
+
+    def save_hook(tensor, name):
+        for pattern, reducer in reducers.items():
+            if fnmatch.fnmatchcase(name, pattern):
+                tensor = reducer(tensor)
+                break
+        activations[name] = tensor
+
+    handles = [
+        (hp, hp.add_hook(save_hook, "fwd"))
+        for hp in base_model.hook_points()
+        if any(fnmatch.fnmatchcase(hp.name, pattern) for pattern in patterns)
+    ]
+
+    def forward(params):
+        activations.clear()
+        logits = functional_call(base_model, params, (evaluator.inputs,))
+        return util.answer_positions(logits, evaluator.digits), dict(activations)
+
+    results = {}
+    try:
+        with torch.no_grad(), backend.autocast():
+            for start in range(0, len(trajectory), chunk_size):
+                chunk = trajectory[start : start + chunk_size].params
+                chunk = {
+                    name: tensor.to(device)
+                    if not tensor.is_floating_point()
+                    else tensor.to(device=device, dtype=backend.get_dtype())
+                    for name, tensor in chunk.items()
+                }
+                logits, chunk_activations = vmap(forward)(chunk)
+                outputs = chunk_metrics(logits, evaluator)
+                if return_logits:
+                    outputs["logits"] = logits
+                outputs.update(chunk_activations)
+                for key, value in outputs.items():
+                    results.setdefault(key, []).append(value.cpu())
+    finally:
+        for hp, handle in handles:
+            hp.remove_hook(handle)
+    return {key: torch.cat(values) for key, values in results.items()}
+
+
+def chunk_metrics(logits, evaluator):
+    # Per-checkpoint losses and accuracies of [checkpoint, p^2, vocab] logits
+    # (or [checkpoint, batch, digits, vocab] for multi-digit answers), as in
+    # util.GridEvaluator
+    labels = evaluator.labels.expand(logits.shape[:-1])
+    logprobs = util.grid_logprobs(logits, labels)
+    correct = logits.argmax(dim=-1) == labels
+    if evaluator.digits > 1:
+        logprobs = logprobs.mean(dim=-1)
+        correct = correct.all(dim=-1)
+    correct = correct.to(torch.float64)
+    metrics = {}
+    for split, mask in [("train", evaluator.is_train), ("test", evaluator.is_test)]:
+        metrics[f"{split}_loss"] = -logprobs[:, mask].mean(dim=-1)
+        metrics[f"{split}_acc"] = correct[:, mask].mean(dim=-1)
+    return metrics
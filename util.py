@@ -1,10 +1,12 @@
+import functools
 import numpy as np
 import einops
 import torch
-import torch.nn.functional as F
 import pandas as pd
+
+import backend
 import data
-from hyperparams import p
+from hyperparams import eval_size, p
 
 
 # Helper functions
@@ -12,24 +14,254 @@ def cuda_memory():
     print(torch.cuda.memory_allocated() / 1e9)
 
 
-def cross_entropy_high_precision(logits, labels):
+def high_precision_logsumexp(logits, chunk_size=4096):
+    # logsumexp over the last dim in float64, casting chunk_size rows at a time
+    # so the full float64 copy of logits is never materialized
+    lse = torch.empty(logits.shape[:-1], dtype=torch.float64, device=logits.device)
+    for start in range(0, logits.shape[0], chunk_size):
+        chunk = logits[start : start + chunk_size].to(torch.float64)
+        lse[start : start + chunk_size] = torch.logsumexp(chunk, dim=-1)
+    return lse
+
+
+class HighPrecisionCrossEntropy(torch.autograd.Function):
+    # Mean cross entropy of batch x vocab logits with float64 precision where it
+    # matters, ie the logsumexp and the reduction, computed in chunks. Forward
+    # keeps only the float64 logsumexp per example, and backward recomputes
+    # softmax - one_hot chunk by chunk in float64, so peak extra memory is one
+    # float64 chunk rather than a float64 copy of all the logits plus the
+    # log_softmax output
+    @staticmethod
+    def forward(ctx, logits, labels, chunk_size):
+        lse = high_precision_logsumexp(logits, chunk_size)
+        label_logits = torch.gather(logits, index=labels[:, None], dim=-1)[:, 0]
+        loss = (lse - label_logits.to(torch.float64)).mean()
+        ctx.save_for_backward(logits, labels, lse)
+        ctx.chunk_size = chunk_size
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_loss):
+        logits, labels, lse = ctx.saved_tensors
+        chunk_size = ctx.chunk_size
+        scale = grad_loss.to(torch.float64) / logits.shape[0]
+        grad_logits = torch.empty_like(logits)
+        for start in range(0, logits.shape[0], chunk_size):
+            end = start + chunk_size
+            chunk = logits[start:end].to(torch.float64)
+            grad_chunk = torch.exp(chunk - lse[start:end, None])
+            rows = torch.arange(grad_chunk.shape[0], device=grad_chunk.device)
+            grad_chunk[rows, labels[start:end]] -= 1
+            grad_logits[start:end] = grad_chunk * scale
+        return grad_logits, None, None
+
+
+def cross_entropy_high_precision(logits, labels, chunk_size=4096):
     # Shapes: batch x vocab, batch
-    # Cast logits to float64 because log_softmax has a float32 underflow on overly
-    # confident data and can only return multiples of 1.2e-7 (the smallest float x
-    # such that 1+x is different from 1 in float32). This leads to loss spikes
-    # and dodgy gradients
-    logprobs = F.log_softmax(logits.to(torch.float64), dim=-1)
-    expanded_labels = labels[:, None] if labels.dim == 1 else labels
-    prediction_logprobs = torch.gather(logprobs, index=expanded_labels, dim=-1)
-    loss = -torch.mean(prediction_logprobs)
-    return loss
-
-
-def full_loss(fn, model, data, digits=1):
+    # Computes the logsumexp in float64 because log_softmax has a float32
+    # underflow on overly confident data and can only return multiples of 1.2e-7
+    # (the smallest float x such that 1+x is different from 1 in float32). This
+    # leads to loss spikes and dodgy gradients. See HighPrecisionCrossEntropy for
+    # how this avoids casting all of logits to float64
+    labels = labels.reshape(-1)
+    return HighPrecisionCrossEntropy.apply(logits, labels, chunk_size)
+
+
+# digits is the number of answer tokens throughout. A multi-digit answer is
+# predicted with teacher forcing: the prompt is followed by all but the last
+# answer token, and the logits at the last digits positions predict each of them
+
+
+def answer_inputs(data, digits=1):
+    # Model inputs for the answers of data.TaskDataset data
+    if digits == 1:
+        return data.inputs
+    return torch.cat([data.inputs, data.labels[:, :-1]], dim=1)
+
+
+def answer_positions(logits, digits=1):
+    # The logits predicting each answer token, batch x vocab for a single token
+    # and batch x digits x vocab otherwise
+    return logits[:, -1] if digits == 1 else logits[:, -digits:]
+
+
+def answer_logits(model, inputs, digits=1):
+    # The model's logits for the answer tokens, under the backend's autocast.
+    # inputs are from answer_inputs
+    with backend.autocast():
+        return answer_positions(model(inputs), digits)
+
+
+def answer_loss(logits, labels):
+    # Mean cross entropy over every answer token
+    return cross_entropy_high_precision(logits.reshape(-1, logits.shape[-1]), labels)
+
+
+def full_loss(model, data, digits=1):
+    # data is a data.TaskDataset, whose inputs and labels already live on the
+    # model's device
     # Take the output logits only
-    logits = model(data)[:, -digits]
-    labels = torch.tensor([fn(i, j) for i, j, _ in data]).to("cuda")
-    return cross_entropy_high_precision(logits, labels)
+    logits = answer_logits(model, answer_inputs(data, digits), digits)
+    return answer_loss(logits, data.labels)
+
+
+def multi_digit_accuracy(model, data):
+    # Accuracy of the answers the model generates (greedily, with its K/V cache)
+    # for a multi-digit data.TaskDataset, per answer token and per whole answer
+    with backend.autocast():
+        generated = model.generate(data.inputs, data.labels.shape[1])
+    correct = generated == data.labels
+    return {
+        "digit_acc": correct.float().mean().item(),
+        "answer_acc": correct.all(dim=1).float().mean().item(),
+    }
+
+
+def batch_chunks(data, chunk_size=None):
+    # Splits data into micro-batches of at most chunk_size examples (all of data
+    # if None), yielding each with its share of data to weight its mean loss
+    # by. Backpropagating every chunk's weighted loss before the next chunk's
+    # forward accumulates exactly the gradient of full_loss, as each example's
+    # gradient is still scaled by 1 / len(data), while only one chunk's
+    # activations are alive at a time
+    if chunk_size is None or chunk_size >= len(data):
+        yield data, 1.0
+        return
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start : start + chunk_size]
+        yield chunk, len(chunk) / len(data)
+
+
+def activation_bytes_per_example(model, data, digits=1, probe_size=64):
+    # Memory a training forward and backward of full_loss holds per example,
+    # measured by recording the storages autograd saves for backward on probes
+    # of probe_size and 2 * probe_size examples. Their difference excludes
+    # parameters, and doubling it allows for the gradients of those activations
+    # during backward
+    def saved_bytes(size):
+        storages = {}
+
+        def pack(tensor):
+            storage = tensor.untyped_storage()
+            storages[storage.data_ptr()] = storage.nbytes()
+            return tensor
+
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            full_loss(model, data[:size], digits)
+        return sum(storages.values())
+
+    probe_size = min(probe_size, len(data) // 2)
+    if probe_size == 0:
+        raise ValueError("Measuring activation memory needs at least 2 examples")
+    extra = saved_bytes(2 * probe_size) - saved_bytes(probe_size)
+    return 2 * max(extra, 1) / probe_size
+
+
+def grad_chunk_size(model, data, max_bytes, digits=1):
+    # The largest micro-batch for batch_chunks whose activations fit in
+    # max_bytes, measured on data, or None (no chunking) if max_bytes is None
+    # or data is too small to split
+    if max_bytes is None or len(data) < 2:
+        return None
+    per_example = activation_bytes_per_example(model, data, digits)
+    return max(int(max_bytes // per_example), 1)
+
+
+def grid_logprobs(logits, labels):
+    # Float64 log probability of each label, as in cross_entropy_high_precision
+    # but without reducing over the batch (or over the answer tokens of
+    # multi-digit logits and labels)
+    label_logits = torch.gather(logits, index=labels[..., None], dim=-1)[..., 0]
+    lse = high_precision_logsumexp(logits.reshape(-1, logits.shape[-1]))
+    return label_logits.to(torch.float64) - lse.reshape(labels.shape)
+
+
+class GridEvaluator:
+    # Evaluates a model on all p^2 inputs with a single no_grad forward, then
+    # splits loss and accuracy by train and test masks. The masks and labels are
+    # scattered from the run's TaskDatasets, so pairs outside a restricted task
+    # count towards neither. Only single-token answers can be read off the grid
+    digits = 1
+
+    def __init__(self, train_data, test_data, num=p):
+        device = train_data.inputs.device
+        self.inputs = data.grid_inputs(num, device)
+        self.labels = torch.zeros(num * num, dtype=torch.long, device=device)
+        self.is_train = torch.zeros(num * num, dtype=torch.bool, device=device)
+        self.is_test = torch.zeros(num * num, dtype=torch.bool, device=device)
+        for mask, dataset in [(self.is_train, train_data), (self.is_test, test_data)]:
+            indices = dataset.inputs[:, 0] * num + dataset.inputs[:, 1]
+            mask[indices] = True
+            self.labels[indices] = dataset.labels
+
+    @torch.no_grad()
+    def logits(self, model, chunk_size=2**16):
+        # Logits for the answer of every input, in grid order. The forward runs
+        # chunk_size inputs at a time, since it produces logits at every
+        # position and only the answer's are kept
+        if len(self.inputs) <= chunk_size:
+            return answer_logits(model, self.inputs, self.digits)
+        logits = None
+        for start in range(0, len(self.inputs), chunk_size):
+            inputs = self.inputs[start : start + chunk_size]
+            chunk = answer_logits(model, inputs, self.digits)
+            if logits is None:
+                shape = (len(self.inputs),) + chunk.shape[1:]
+                logits = chunk.new_empty(shape)
+            logits[start : start + chunk_size] = chunk
+        return logits
+
+    def __call__(self, model):
+        return self.metrics(self.logits(model))
+
+    def metrics(self, logits):
+        # Losses are means over answer tokens, and accuracies count an answer
+        # as correct only if all its tokens are
+        logprobs = grid_logprobs(logits, self.labels)
+        correct = logits.argmax(dim=-1) == self.labels
+        if self.digits > 1:
+            correct = correct.all(dim=-1)
+        return {
+            "train_loss": -logprobs[self.is_train].mean().item(),
+            "test_loss": -logprobs[self.is_test].mean().item(),
+            "train_acc": correct[self.is_train].float().mean().item(),
+            "test_acc": correct[self.is_test].float().mean().item(),
+        }
+
+
+class SampleEvaluator(GridEvaluator):
+    # GridEvaluator's metrics for runs streaming data.IndexDatasets, over fixed
+    # samples of size pairs from each of the train and test splits rather than
+    # the whole grid. Its logits aren't in grid order, so progress measures
+    # can't use them
+    def __init__(self, train_data, test_data, size=eval_size, device=None):
+        train = train_data.sample(size, device)
+        test = test_data.sample(size, device)
+        self.inputs = torch.cat([train.inputs, test.inputs])
+        self.labels = torch.cat([train.labels, test.labels])
+        positions = torch.arange(len(self.inputs), device=self.inputs.device)
+        self.is_train = positions < len(train)
+        self.is_test = ~self.is_train
+
+
+class MultiDigitEvaluator(GridEvaluator):
+    # GridEvaluator's metrics for multi-digit TaskDatasets (labels batch x
+    # digits), over all of their pairs with teacher forcing. A teacher-forced
+    # answer has all its tokens right exactly when greedy generation gets it
+    # right, so the accuracies are those of generated answers too. Its logits
+    # aren't in grid order, so progress measures can't use them
+    def __init__(self, train_data, test_data):
+        self.digits = train_data.labels.shape[1]
+        self.inputs = torch.cat(
+            [
+                answer_inputs(train_data, self.digits),
+                answer_inputs(test_data, self.digits),
+            ]
+        )
+        self.labels = torch.cat([train_data.labels, test_data.labels])
+        positions = torch.arange(len(self.inputs), device=self.inputs.device)
+        self.is_train = positions < len(train_data)
+        self.is_test = ~self.is_train
 
 
 def test_logits(
@@ -37,12 +269,21 @@ def test_logits(
     bias_correction=False,
     original_logits=None,
     mode="all",
-    is_train=data.is_train,
-    is_test=data.is_test,
+    is_train=None,
+    is_test=None,
+    labels=None,
+    fn_name="add",
 ):
     # Calculates cross entropy loss of logits representing a batch of all p^2
     # possible inputs
     # Batch dimension is assumed to be first
+    # labels default to fn_name's labels over the grid, and the masks to its
+    # default split, leaving out pairs where a restricted task is undefined
+    if is_train is None or is_test is None:
+        task = fn_name if fn_name in data.RESTRICTED_TASKS else None
+        is_train, is_test = data.get_predicate_arrays(task=task)
+    if labels is None:
+        labels = data.grid_labels(fn_name, device=logits.device)
     if logits.shape[1] == p * p:
         logits = logits.T
     if logits.shape == torch.Size([p * p, p + 1]):
@@ -63,9 +304,9 @@ def test_logits(
         return cross_entropy_high_precision(logits, labels)
 
 
-def unflatten_first(tensor):
-    if tensor.shape[0] == p * p:
-        return einops.rearrange(tensor, "(x y) ... -> x y ...", x=p, y=p)
+def unflatten_first(tensor, num=p):
+    if tensor.shape[0] == num * num:
+        return einops.rearrange(tensor, "(x y) ... -> x y ...", x=num, y=num)
     else:
         return tensor
 
@@ -106,33 +347,136 @@ def is_close(a, b):
     ).item()
 
 
-neel_fourier_basis = []
-neel_fourier_basis.append(torch.ones(p) / np.sqrt(p))
-neel_fourier_basis_names = ["Const"]
-# Note that if p is even, we need to explicitly add a term for cos(kpi), ie
-# alternating +1 and -1
-for i in range(1, p // 2 + 1):
-    neel_fourier_basis.append(torch.cos(2 * torch.pi * torch.arange(p) * i / p))
-    neel_fourier_basis.append(torch.sin(2 * torch.pi * torch.arange(p) * i / p))
-    neel_fourier_basis[-2] /= neel_fourier_basis[-2].norm()
-    neel_fourier_basis[-1] /= neel_fourier_basis[-1].norm()
-    neel_fourier_basis_names.append(f"cos {i}")
-    neel_fourier_basis_names.append(f"sin {i}")
-neel_fourier_basis = torch.stack(neel_fourier_basis, dim=0).to("cuda")
+# The Fourier bases are built on first use and memoized per (p, device, dtype),
+# so importing this module does no tensor work and several moduli can coexist
+def get_neel_fourier_basis_names(num=p):
+    names = ["Const"]
+    for i in range(1, num // 2 + 1):
+        names.append(f"cos {i}")
+        names.append(f"sin {i}")
+    return names
+
+
+def get_neel_fourier_basis(num=p, device=None, dtype=torch.float32):
+    device = torch.device(device or backend.get_device())
+    return _neel_fourier_basis(num, device, dtype)
+
 
+@functools.lru_cache(maxsize=None)
+def _neel_fourier_basis(num, device, dtype):
+    fourier_basis = []
+    fourier_basis.append(torch.ones(num) / np.sqrt(num))
+    # Note that if p is even, we need to explicitly add a term for cos(kpi), ie
+    # alternating +1 and -1
+    for i in range(1, num // 2 + 1):
+        fourier_basis.append(torch.cos(2 * torch.pi * torch.arange(num) * i / num))
+        fourier_basis.append(torch.sin(2 * torch.pi * torch.arange(num) * i / num))
+        fourier_basis[-2] /= fourier_basis[-2].norm()
+        fourier_basis[-1] /= fourier_basis[-1].norm()
+    return torch.stack(fourier_basis, dim=0).to(device=device, dtype=dtype)
 
-sin_fourier_basis = []
-sin_fourier_basis.append(torch.ones(p) / np.sqrt(p))
-sin_fourier_basis_names = ["Const"]
-for i in range(1, p):
-    x = torch.sin(2 * torch.pi * torch.arange(p) * i / p)
-    sin_fourier_basis.append(x / x.norm())
-    sin_fourier_basis_names.append(f"sin {i}")
-sin_fourier_basis = torch.stack(sin_fourier_basis, dim=0).to("cuda")
+
+def get_sin_fourier_basis_names(num=p):
+    return ["Const"] + [f"sin {i}" for i in range(1, num)]
+
+
+def get_sin_fourier_basis(num=p, device=None, dtype=torch.float32):
+    device = torch.device(device or backend.get_device())
+    return _sin_fourier_basis(num, device, dtype)
+
+
+@functools.lru_cache(maxsize=None)
+def _sin_fourier_basis(num, device, dtype):
+    fourier_basis = []
+    fourier_basis.append(torch.ones(num) / np.sqrt(num))
+    for i in range(1, num):
+        x = torch.sin(2 * torch.pi * torch.arange(num) * i / num)
+        fourier_basis.append(x / x.norm())
+    return torch.stack(fourier_basis, dim=0).to(device=device, dtype=dtype)
+
+
+# Module attributes kept from when the bases were built at import, now resolved
+# lazily for the default p and backend
+def __getattr__(name):
+    if name == "neel_fourier_basis":
+        return get_neel_fourier_basis()
+    if name == "neel_fourier_basis_names":
+        return get_neel_fourier_basis_names()
+    if name == "sin_fourier_basis":
+        return get_sin_fourier_basis()
+    if name == "sin_fourier_basis_names":
+        return get_sin_fourier_basis_names()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Smallest modulus at which fft1d and fft2d use the FFT rather than a matmul with
+# the basis. The FFT is O(p^2 log p) per channel rather than O(p^3), but on CPU
+# it is memory bound, and a single threaded MKL matmul stays as fast up to p ~ 1000
+FFT_MIN_MODULUS = 1000
+
+
+def is_neel_fourier_basis(fourier_basis):
+    # Whether fourier_basis is the cached neel_fourier_basis for an odd modulus,
+    # whose coefficients neel_fft1d can compute
+    num = fourier_basis.shape[-1]
+    return (
+        num % 2 == 1
+        and fourier_basis.shape[0] == num
+        and fourier_basis
+        is _neel_fourier_basis(num, fourier_basis.device, fourier_basis.dtype)
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _neel_fft_scale(num, device, dtype):
+    # Maps the real and imaginary parts of rfft's num // 2 + 1 frequencies to
+    # the Const, cos k and sin k coefficients, whose basis vectors have norms
+    # sqrt(num) and sqrt(num / 2)
+    scale = torch.full((num // 2 + 1, 2), np.sqrt(2 / num), dtype=dtype)
+    scale[0] = 1 / np.sqrt(num)
+    scale[:, 1] *= -1
+    return scale.to(device)
+
+
+def neel_fft1d(tensor, dim=-1):
+    # Coefficients of tensor along dim (of odd size p) in neel_fourier_basis, ie
+    # the same as a matmul with the basis but in O(p log p) with rfft, whose kth
+    # term is sum_x f(x) (cos - i sin)(2 pi k x / p). Other dims are batch dims
+    dim = dim % tensor.dim()
+    num = tensor.shape[dim]
+    assert num % 2 == 1, "neel_fft1d needs an odd modulus"
+    # rfft doesn't support half precision on every device
+    compute_dtype = torch.promote_types(tensor.dtype, torch.float32)
+    spectrum = torch.fft.rfft(tensor.to(compute_dtype), dim=dim)
+    # [..., frequency, real/imag, ...], which interleaves into the basis order
+    # Const, 0, cos 1, sin 1, cos 2, ... once scaled
+    parts = torch.view_as_real(spectrum).movedim(-1, dim + 1)
+    scale = _neel_fft_scale(num, tensor.device, compute_dtype)
+    scale = scale.reshape(scale.shape + (1,) * (tensor.dim() - dim - 1))
+    # Writing into a contiguous tensor makes the interleave a single pass
+    coefficients = torch.empty(parts.shape, dtype=compute_dtype, device=tensor.device)
+    torch.mul(parts, scale, out=coefficients)
+    coefficients = coefficients.flatten(dim, dim + 1)
+    # Drop the zero frequency's imaginary part, which is always 0
+    coefficients.select(dim, 1).copy_(coefficients.select(dim, 0))
+    return coefficients.narrow(dim, 1, num).to(tensor.dtype)
+
+
+def neel_fft2d(mat, dim=0, num=p):
+    # 2D version of neel_fft1d: mat has a flattened (x y) grid of size p^2 at dim
+    # and any other leading (eg checkpoint) or trailing dims, and the result has
+    # the same shape, matching fft2d with neel_fourier_basis
+    dim = dim % mat.dim()
+    grid = mat.unflatten(dim, (num, num))
+    grid = neel_fft1d(neel_fft1d(grid, dim), dim + 1)
+    return grid.reshape(mat.shape)
 
 
 def fft1d(fourier_basis, tensor):
     # Converts a tensor with dimension p into the Fourier basis
+    num = fourier_basis.shape[-1]
+    if num >= FFT_MIN_MODULUS and is_neel_fourier_basis(fourier_basis):
+        return neel_fft1d(tensor)
     return tensor @ fourier_basis.T
 
 
@@ -148,14 +492,18 @@ def fft2d(fourier_basis, mat):
     # Converts a pxpx... or batch x ... tensor into the 2D Fourier basis.
     # Output has the same shape as the original
     shape = mat.shape
-    mat = einops.rearrange(mat, "(x y) ... -> x y (...)", x=p, y=p)
+    num = fourier_basis.shape[-1]
+    if num >= FFT_MIN_MODULUS and is_neel_fourier_basis(fourier_basis):
+        return neel_fft2d(mat, num=num)
+    mat = einops.rearrange(mat, "(x y) ... -> x y (...)", x=num, y=num)
     fourier_mat = torch.einsum("xyz,fx,Fy->fFz", mat, fourier_basis, fourier_basis)
     return fourier_mat.reshape(shape)
 
 
-def analyse_fourier_2d(tensor, top_k=10):
+def analyse_fourier_2d(tensor, top_k=10, num=p):
     # Processes a (p,p) or (p*p) tensor in the 2D Fourier Basis, showing the
     # top_k terms and how large a fraction of the variance they explain
+    neel_fourier_basis_names = get_neel_fourier_basis_names(num)
     values, indices = tensor.flatten().pow(2).sort(descending=True)
     rows = []
     total = values.sum().item()
@@ -165,8 +513,8 @@ def analyse_fourier_2d(tensor, top_k=10):
                 tensor.flatten()[indices[i]].item(),
                 values[i].item() / total,
                 values[: i + 1].sum().item() / total,
-                neel_fourier_basis_names[indices[i].item() // p],
-                neel_fourier_basis_names[indices[i] % p],
+                neel_fourier_basis_names[indices[i].item() // num],
+                neel_fourier_basis_names[indices[i] % num],
             ]
         )
     display(
@@ -190,13 +538,33 @@ def get_2d_fourier_component(tensor, x, y):
     return vec[:, None] @ (vec[None, :] @ tensor)
 
 
+def get_xpy_directions(num=p, device=None, dtype=torch.float32):
+    # [freq - 1, 2, num^2] unit vectors of cos(freq*(x+y)) and sin(freq*(x+y))
+    # over the flattened grid, for freq from 1 to num // 2
+    device = torch.device(device or backend.get_device())
+    return _xpy_directions(num, device, dtype)
+
+
+@functools.lru_cache(maxsize=None)
+def _xpy_directions(num, device, dtype):
+    fourier_basis = _neel_fourier_basis(num, device, dtype)
+    directions = []
+    for freq in range(1, num // 2 + 1):
+        cosx_cosy = fourier_2d_basis_term(fourier_basis, 2 * freq - 1, 2 * freq - 1)
+        sinx_siny = fourier_2d_basis_term(fourier_basis, 2 * freq, 2 * freq)
+        sinx_cosy = fourier_2d_basis_term(fourier_basis, 2 * freq, 2 * freq - 1)
+        cosx_siny = fourier_2d_basis_term(fourier_basis, 2 * freq - 1, 2 * freq)
+        # Divide by sqrt(2) to ensure they remain normalised
+        cos_xpy = (cosx_cosy - sinx_siny) / np.sqrt(2)
+        sin_xpy = (sinx_cosy + cosx_siny) / np.sqrt(2)
+        directions.append(torch.stack([cos_xpy, sin_xpy]))
+    return torch.stack(directions)
+
+
 def get_component_cos_xpy(tensor, freq, collapse_dim=False):
     # Gets the component corresponding to cos(freq*(x+y)) in the 2D Fourier basis
     # This is equivalent to the matrix cos((x+y)*freq*2pi/p)
-    cosx_cosy_direction = fourier_2d_basis_term(2 * freq - 1, 2 * freq - 1).flatten()
-    sinx_siny_direction = fourier_2d_basis_term(2 * freq, 2 * freq).flatten()
-    # Divide by sqrt(2) to ensure it remains normalised
-    cos_xpy_direction = (cosx_cosy_direction - sinx_siny_direction) / np.sqrt(2)
+    cos_xpy_direction = get_xpy_directions(p, tensor.device, tensor.dtype)[freq - 1, 0]
     # Collapse_dim says whether to project back into R^(p*p) space or not
     if collapse_dim:
         return cos_xpy_direction @ tensor
@@ -206,9 +574,7 @@ def get_component_cos_xpy(tensor, freq, collapse_dim=False):
 
 def get_component_sin_xpy(tensor, freq, collapse_dim=False):
     # Gets the component corresponding to sin((x+y)*freq*2pi/p) in the 2D Fourier basis
-    sinx_cosy_direction = fourier_2d_basis_term(2 * freq, 2 * freq - 1).flatten()
-    cosx_siny_direction = fourier_2d_basis_term(2 * freq - 1, 2 * freq).flatten()
-    sin_xpy_direction = (sinx_cosy_direction + cosx_siny_direction) / np.sqrt(2)
+    sin_xpy_direction = get_xpy_directions(p, tensor.device, tensor.dtype)[freq - 1, 1]
     if collapse_dim:
         return sin_xpy_direction @ tensor
     else: